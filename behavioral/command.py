@@ -6,25 +6,77 @@ Data: 19/02/2025
 """
 
 from __future__ import annotations
+import asyncio
+import heapq
+import os
+import pickle
+import sys
 from abc import ABC, abstractmethod
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+from zlib import crc32
 
 
 class AbstractCommand(ABC):
     '''
     Interface de comando abstrato que declara um método de execução
+    
+    Um comando pode declarar que depende de outros (depends_on). Invok-
+    ers que executam em paralelo usam essas dependências para decidir o
+    que pode rodar ao mesmo tempo.
+    
+    Um comando idempotente (idempotent = True) produz sempre o mesmo re-
+    sultado para a mesma chave (cache_key), e pode ter a execução subs-
+    tituída por um resultado guardado em cache.
     '''
     
+    _dependencies : Tuple[AbstractCommand, ...] = ()
+    idempotent : bool = False
+    
     @abstractmethod
     def execute(self) -> None:
         pass
     
+    def cache_key(self) -> Hashable:
+        return None
+    
+    @property
+    def dependencies(self) -> Tuple[AbstractCommand, ...]:
+        return self._dependencies
+    
+    def depends_on(self, *cmds: AbstractCommand) -> AbstractCommand:
+        self._dependencies = self._dependencies + cmds
+        return self
+    
+
+def _frozen(value: Any) -> Hashable:
+    '''
+    Versão hashable de params com listas, dicionários e conjuntos ani-
+    nhados, para compor a chave de cache
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _frozen(v)) for k, v in value.items())
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+    
 
 class SimpleCommand(AbstractCommand):
     '''
     Comandos simples podem implementar o código associado à uma tarefa
     sozinhos
     '''
+    
+    def __init__(self, foo: str = 'bar') -> None:
+        self._foo : str = foo
             
     def execute(self) -> None:
         print(f"Fazendo algo simples, com foo = {self._foo}")
@@ -33,16 +85,116 @@ class ComplexCommand(AbstractCommand):
     '''
     Tarefas mais complexas são delegadas para outras classes, chamadas
     receivers, onde a operação lógica fica implementada
+    
+    Como o receiver pode ter efeitos colaterais, o comando só é tratado
+    como idempotente se isso for pedido (idempotent = True na instância
+    ou em uma subclasse).
     '''
     
-    def __init__(self, receiver: Receiver) -> None:
+    def __init__(self, receiver: Receiver,
+                 params: Optional[list] = None) -> None:
         self._receiver : Receiver = receiver
-        self._params : list = [1, 2, 3]
+        self._params : list = [1, 2, 3] if params is None else params
+        self.result : Any = None
         
-    def execute(self) -> None:
+    @property
+    def receiver(self) -> Receiver:
+        return self._receiver
+    
+    @property
+    def params(self) -> list:
+        return self._params
+        
+    def execute(self) -> Any:
         print("Fazendo algo complexo, com auxílio de um receiver!")
-        self._receiver.task(self._params)
+        self.result = self._receiver.task(self._params)
+        return self.result
+    
+    def cache_key(self) -> Hashable:
+        return (self._receiver, _frozen(self._params))
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        '''
+        O resultado não vai para o journal
+        '''
+        return {**self.__dict__, 'result': None}
+        
+
+MISSING = object()
+
+
+class AbstractUndoableCommand(AbstractCommand):
+    '''
+    Comandos que podem ser desfeitos. Depois de executar, o comando ex-
+    põe a mudança que fez como um delta compacto (chave, valor antigo,
+    valor novo), que o histórico usa para desfazer e refazer.
+    '''
+    
+    @abstractmethod
+    def undo(self) -> None:
+        pass
+    
+    @property
+    @abstractmethod
+    def delta(self) -> Tuple[Hashable, Any, Any]:
+        pass
+
+
+class SetCommand(AbstractUndoableCommand):
+    '''
+    Atribui um valor a uma chave do estado de um StatefulReceiver
+    '''
+    
+    def __init__(self, receiver: StatefulReceiver, key: Hashable,
+                 value: Any) -> None:
+        self._receiver = receiver
+        self._key = key
+        self._value = value
+        self._old : Any = MISSING
+        
+    def execute(self) -> None:
+        self._old = self._receiver.state.get(self._key, MISSING)
+        self._receiver.set(self._key, self._value)
+        
+    def undo(self) -> None:
+        self._receiver.set(self._key, self._old)
+        
+    @property
+    def delta(self) -> Tuple[Hashable, Any, Any]:
+        return (self._key, self._old, self._value)
+
+
+class AbstractAsyncCommand(AbstractCommand):
+    '''
+    Comando assíncrono: a execução é uma corotina, útil quando o traba-
+    lho do receiver é esperar por I/O
+    '''
+    
+    @abstractmethod
+    async def execute(self) -> Any:
+        pass
+
+
+class AsyncComplexCommand(AbstractAsyncCommand):
+    '''
+    Versão assíncrona do ComplexCommand, que delega para um AsyncRecei-
+    ver
+    '''
+    
+    def __init__(self, receiver: AsyncReceiver,
+                 params: Optional[list] = None) -> None:
+        self._receiver : AsyncReceiver = receiver
+        self._params : list = [1, 2, 3] if params is None else params
+        self.result : Any = None
         
+    async def execute(self) -> Any:
+        print("Fazendo algo complexo e assíncrono, com auxílio de um receiver!")
+        self.result = await self._receiver.task(self._params)
+        return self.result
+    
+    def cache_key(self) -> Hashable:
+        return (self._receiver, _frozen(self._params))
+
 
 class Receiver:
     '''
@@ -52,6 +204,378 @@ class Receiver:
     def task(self, params: list) -> None:
         print(f"Receiver faz algo com params = {params}")
         
+    def task_batch(self, batch: List[list]) -> List[Any]:
+        '''
+        Recebe os params de vários comandos de uma vez e devolve um re-
+        sultado por comando, na mesma ordem. Receivers que conseguem pro-
+        cessar o lote todo de forma vetorizada devem sobrescrever esse
+        método; o padrão apenas repete task.
+        '''
+        return [self.task(params) for params in batch]
+
+
+class AsyncReceiver:
+    '''
+    Receiver cujas operações esperam por I/O sem bloquear uma thread
+    '''
+    
+    def __init__(self, delay: float = 0.01) -> None:
+        self._delay = delay
+    
+    async def task(self, params: list) -> None:
+        await asyncio.sleep(self._delay)
+        print(f"AsyncReceiver faz algo com params = {params}")
+
+
+class StatefulReceiver(Receiver):
+    '''
+    Receiver com estado (um dicionário), alterado por comandos desfazí-
+    veis. Atribuir MISSING a uma chave remove a chave.
+    '''
+    
+    def __init__(self) -> None:
+        self.state : Dict[Hashable, Any] = {}
+        
+    def set(self, key: Hashable, value: Any) -> None:
+        if value is MISSING:
+            self.state.pop(key, None)
+        else:
+            self.state[key] = value
+            
+    def snapshot(self) -> Dict[Hashable, Any]:
+        return dict(self.state)
+    
+    def restore(self, snapshot: Dict[Hashable, Any]) -> None:
+        self.state = dict(snapshot)
+
+
+class CommandHistory:
+    '''
+    Histórico de desfazer/refazer com memória limitada. Ao invés de uma
+    cópia completa do estado por comando, o histórico guarda o delta de
+    cada comando e, a cada snapshot_every comandos, um snapshot comple-
+    to do receiver.
+    
+    Desfazer ou refazer um passo aplica um único delta. Ir para um pon-
+    to distante (goto) restaura o snapshot mais próximo antes do alvo e
+    aplica no máximo snapshot_every deltas. Quando o tamanho estimado
+    passa de max_bytes, os deltas e snapshots mais antigos são descar-
+    tados, e o começo do histórico avança.
+    '''
+    
+    _deltas : List[Tuple[Hashable, Any, Any]]
+    _snapshots : Dict[int, Dict[Hashable, Any]]
+    
+    def __init__(self, receiver: StatefulReceiver, snapshot_every: int = 64,
+                 max_bytes: int = 64 * 2**20) -> None:
+        self._receiver = receiver
+        self._snapshot_every = snapshot_every
+        self._max_bytes = max_bytes
+        self._deltas = []
+        self._snapshots = {0: receiver.snapshot()}
+        self._first = 0
+        self._position = 0
+        self.bytes = self._sizeof_snapshot(self._snapshots[0])
+        
+    @staticmethod
+    def _sizeof_delta(delta: Tuple[Hashable, Any, Any]) -> int:
+        return sys.getsizeof(delta) + sum(map(sys.getsizeof, delta))
+    
+    @staticmethod
+    def _sizeof_snapshot(snapshot: Dict[Hashable, Any]) -> int:
+        return sys.getsizeof(snapshot) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in snapshot.items()
+        )
+        
+    @property
+    def position(self) -> int:
+        return self._position
+    
+    @property
+    def first(self) -> int:
+        return self._first
+    
+    @property
+    def last(self) -> int:
+        return self._first + len(self._deltas)
+        
+    def record(self, cmd: AbstractUndoableCommand) -> None:
+        if self._position < self.last:
+            self._truncate()
+        delta = cmd.delta
+        self._deltas.append(delta)
+        self._position += 1
+        self.bytes += self._sizeof_delta(delta)
+        if self._position % self._snapshot_every == 0:
+            snapshot = self._receiver.snapshot()
+            self._snapshots[self._position] = snapshot
+            self.bytes += self._sizeof_snapshot(snapshot)
+        self._evict()
+        
+    def _truncate(self) -> None:
+        '''
+        Um novo comando depois de desfazer descarta o que podia ser re-
+        feito
+        '''
+        for delta in self._deltas[self._position - self._first:]:
+            self.bytes -= self._sizeof_delta(delta)
+        del self._deltas[self._position - self._first:]
+        for pos in [p for p in self._snapshots if p > self._position]:
+            self.bytes -= self._sizeof_snapshot(self._snapshots.pop(pos))
+            
+    def _evict(self) -> None:
+        while self.bytes > self._max_bytes and self._first < self._position:
+            later = [p for p in self._snapshots if p > self._first]
+            cut = min(min(later, default=self._position), self._position)
+            for delta in self._deltas[:cut - self._first]:
+                self.bytes -= self._sizeof_delta(delta)
+            del self._deltas[:cut - self._first]
+            for pos in [p for p in self._snapshots if p < cut]:
+                self.bytes -= self._sizeof_snapshot(self._snapshots.pop(pos))
+            self._first = cut
+        
+    def undo(self) -> bool:
+        if self._position <= self._first:
+            return False
+        key, old, _ = self._deltas[self._position - self._first - 1]
+        self._receiver.set(key, old)
+        self._position -= 1
+        return True
+        
+    def redo(self) -> bool:
+        if self._position >= self.last:
+            return False
+        key, _, new = self._deltas[self._position - self._first]
+        self._receiver.set(key, new)
+        self._position += 1
+        return True
+    
+    def goto(self, target: int) -> None:
+        if not self._first <= target <= self.last:
+            raise IndexError('Posição fora do histórico')
+        base = max((p for p in self._snapshots if p <= target), default=None)
+        if base is not None and abs(target - self._position) > target - base:
+            self._receiver.restore(self._snapshots[base])
+            self._position = base
+        while self._position < target:
+            self.redo()
+        while self._position > target:
+            self.undo()
+
+
+class CommandJournal:
+    '''
+    Diário de comandos (write-ahead log) em um arquivo só de acréscimos.
+    Cada registro é um cabeçalho binário (tamanho, crc32, tipo e número
+    de sequência) seguido do comando serializado com pickle. Quando um
+    comando termina, o invoker grava um marcador de conclusão com a sua
+    sequência, só o cabeçalho, sem payload.
+    
+    O append apenas escreve no buffer do arquivo. O commit faz um único
+    fsync para todos os registros pendentes (group commit), e acontece
+    sozinho a cada group_size registros. Depois de uma queda, replay lê
+    o arquivo via mmap, para no primeiro registro incompleto ou corrom-
+    pido, que nunca chegou a ser confirmado, e devolve só os comandos
+    sem marcador de conclusão. Um marcador perdido na queda faz o coman-
+    do executar de novo (entrega pelo menos uma vez). Ao reabrir o diá-
+    rio, esse registro incompleto é cortado antes dos novos acréscimos.
+    
+    O arquivo não cresce sem limite: quando passa de checkpoint_bytes e
+    não há comando em aberto, ele é truncado; checkpoint reescreve o ar-
+    quivo só com os comandos em aberto. O registro é o pickle do coman-
+    do, então comandos que precisam de registros menores podem definir
+    __getstate__ ou __reduce__, como qualquer objeto serializável.
+    '''
+    
+    RECORD = Struct('<IIBQ')
+    COMMAND, DONE = 0, 1
+    
+    _open : Dict[int, None]
+    
+    def __init__(self, path: str, group_size: int = 256,
+                 checkpoint_bytes: int = 2**20) -> None:
+        self._path = path
+        self._group_size = group_size
+        self._checkpoint_bytes = checkpoint_bytes
+        self._open = {}
+        self._seq = 0
+        records, end = self._records(path)
+        for seq, kind, _ in records:
+            self._seq = max(self._seq, seq)
+            if kind == self.COMMAND:
+                self._open[seq] = None
+            else:
+                self._open.pop(seq, None)
+        self._file = open(path, 'ab')
+        if self._file.tell() > end:
+            self._file.truncate(end)
+            os.fsync(self._file.fileno())
+        self._lock = Lock()
+        self._pending = 0
+        self.commits = 0
+        
+    def __len__(self) -> int:
+        '''
+        Quantos comandos gravados ainda não terminaram
+        '''
+        return len(self._open)
+    
+    def _write(self, kind: int, seq: int, payload: bytes = b'') -> None:
+        crc = crc32(payload, crc32(self.RECORD.pack(0, 0, kind, seq)))
+        self._file.write(self.RECORD.pack(len(payload), crc, kind, seq))
+        self._file.write(payload)
+        self._pending += 1
+        if self._pending >= self._group_size:
+            self._commit()
+        
+    def append(self, cmd: AbstractCommand) -> int:
+        '''
+        Grava o comando e devolve a sua sequência
+        '''
+        payload = pickle.dumps(cmd, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._seq += 1
+            self._open[self._seq] = None
+            self._write(self.COMMAND, self._seq, payload)
+            return self._seq
+    
+    def complete(self, seq: int) -> None:
+        with self._lock:
+            if self._open.pop(seq, MISSING) is MISSING:
+                return
+            self._write(self.DONE, seq)
+            if not self._open and self._file.tell() >= self._checkpoint_bytes:
+                self._commit()
+                self._file.truncate(0)
+            
+    def commit(self) -> None:
+        with self._lock:
+            self._commit()
+            
+    def _commit(self) -> None:
+        if not self._pending:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self.commits += 1
+        
+    def checkpoint(self) -> None:
+        '''
+        Reescreve o arquivo só com os comandos em aberto e troca o anti-
+        go pelo novo de forma atômica
+        '''
+        with self._lock:
+            self._commit()
+            self._file.close()
+            fd, tmp = mkstemp(dir=os.path.dirname(os.path.abspath(self._path)))
+            with os.fdopen(fd, 'wb') as file:
+                self._file = file
+                for seq, kind, payload in self._records(self._path)[0]:
+                    if kind == self.COMMAND and seq in self._open:
+                        self._write(kind, seq, payload)
+                self._commit()
+            os.replace(tmp, self._path)
+            self._file = open(self._path, 'ab')
+        
+    def close(self) -> None:
+        self.commit()
+        self._file.close()
+        
+    @classmethod
+    def _records(cls, path: str) -> Tuple[List[Tuple[int, int, bytes]], int]:
+        '''
+        Os registros válidos e a posição onde eles terminam. O que vier
+        depois é um registro incompleto deixado por uma queda
+        '''
+        records = []
+        offset = 0
+        if not os.path.exists(path):
+            return records, offset
+        with open(path, 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                return records, offset
+            with mmap(file.fileno(), 0, access=ACCESS_READ) as buffer:
+                while offset + cls.RECORD.size <= len(buffer):
+                    size, crc, kind, seq = cls.RECORD.unpack_from(buffer,
+                                                                  offset)
+                    start = offset + cls.RECORD.size
+                    payload = buffer[start:start + size]
+                    if len(payload) < size or crc32(payload, crc32(
+                            cls.RECORD.pack(0, 0, kind, seq))) != crc:
+                        break
+                    records.append((seq, kind, payload))
+                    offset = start + size
+        return records, offset
+        
+    @classmethod
+    def replay(cls, path: str) -> List[AbstractCommand]:
+        '''
+        Os comandos gravados que não terminaram, na ordem de gravação
+        '''
+        payloads : Dict[int, bytes] = {}
+        for seq, kind, payload in cls._records(path)[0]:
+            if kind == cls.COMMAND:
+                payloads[seq] = payload
+            else:
+                payloads.pop(seq, None)
+        return [pickle.loads(payload) for payload in payloads.values()]
+
+
+class ResultCache:
+    '''
+    Cache de resultados de comandos idempotentes, limitado a maxsize en-
+    tradas. A entrada menos usada recentemente é descartada primeiro
+    (LRU) e, com ttl, entradas mais velhas que ttl segundos expiram.
+    '''
+    
+    _data : OrderedDict[Hashable, Tuple[Optional[float], Any]]
+    
+    def __init__(self, maxsize: int = 1024,
+                 ttl: Optional[float] = None) -> None:
+        self._data = OrderedDict()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def __len__(self) -> int:
+        return len(self._data)
+        
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        '''
+        Retorna (encontrado, resultado)
+        '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None \
+                    and entry[0] <= monotonic():
+                del self._data[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+        
+    def put(self, key: Hashable, result: Any) -> None:
+        expires = None if self._ttl is None else monotonic() + self._ttl
+        with self._lock:
+            self._data[key] = (expires, result)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+                
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._data)}
+
 
 class Invoker:
     '''
@@ -61,29 +585,452 @@ class Invoker:
     
     Aqui, esse é um exemplo de invoker que "protege" uma tarefa de outr-
     as, que devem vir antes e depois.
+    
+    Com um journal, todos os comandos pendentes são gravados de forma
+    durável, com um único commit, antes de qualquer um executar. Com um
+    cache, execuções repetidas de comandos idempotentes são servidas pe-
+    lo resultado guardado.
+    
+    Com batch=True, os ComplexCommand seguidos de uma lista que usam o
+    mesmo receiver são agrupados em uma única chamada de task_batch, e
+    cada comando recebe o seu resultado em result. Subclasses que sobre-
+    screvem execute não entram no lote. Os demais comandos executam um
+    a um, na sua posição da lista, entre os lotes.
+    
+    Com um history, cada comando desfazível executado é registrado, e
+    pode ser desfeito e refeito depois.
     '''
     
-    def __init__(self) -> None:
+    asynchronous = False
+    
+    def __init__(self, journal: Optional[CommandJournal] = None,
+                 cache: Optional[ResultCache] = None,
+                 batch: bool = False,
+                 history: Optional[CommandHistory] = None) -> None:
         self._before: List[AbstractCommand] = []
         self._after: List[AbstractCommand] = []
+        self._journal = journal
+        self._journaled : Dict[int, List[int]] = {}
+        self._cache = cache
+        self._batch = batch
+        self._history = history
+        
+    @property
+    def history(self) -> Optional[CommandHistory]:
+        return self._history
         
     def append_command_before(self, cmd: AbstractCommand) -> None:
+        self._check(cmd)
         self._before.append(cmd)
         
     def append_command_after(self, cmd: AbstractCommand) -> None:
+        self._check(cmd)
         self._after.append(cmd)
         
     def do_something_important(self) -> bool:
+        self._log_pending()
+        if self._before:
+            self._execute_all(self._before)
+            self._before.clear()
+        print('-- Invoker fazendo algo "protegido" --')
+        if self._after:
+            self._execute_all(self._after)
+            self._after.clear()
+        return True
+    
+    def _log_pending(self) -> None:
+        if self._journal is not None:
+            for cmd in self._before + self._after:
+                self._track(cmd, self._journal.append(cmd))
+            self._journal.commit()
+            
+    def _track(self, cmd: AbstractCommand, seq: int) -> None:
+        self._journaled.setdefault(id(cmd), []).append(seq)
+            
+    def _done(self, cmd: AbstractCommand) -> None:
+        '''
+        Grava no journal que uma execução do comando terminou
+        '''
+        seqs = self._journaled.get(id(cmd))
+        if not seqs:
+            return
+        seq = seqs.pop(0)
+        if not seqs:
+            self._journaled.pop(id(cmd), None)
+        self._journal.complete(seq)
+    
+    def _execute_all(self, cmds: List[AbstractCommand]) -> None:
+        if not self._batch:
+            for cmd in cmds:
+                self._run(cmd)
+            return
+        groups : Dict[int, List[ComplexCommand]] = {}
+        for cmd in cmds:
+            if type(cmd).execute is ComplexCommand.execute:
+                groups.setdefault(id(cmd.receiver), []).append(cmd)
+                continue
+            for group in groups.values():
+                self._run_batch(group)
+            groups.clear()
+            self._run(cmd)
+        for group in groups.values():
+            self._run_batch(group)
+            
+    def _run_batch(self, cmds: List[ComplexCommand]) -> None:
+        self._task_batch(cmds)
+        for cmd in cmds:
+            self._done(cmd)
+            
+    def _task_batch(self, cmds: List[ComplexCommand]) -> None:
+        if self._cache is not None:
+            missing = []
+            for cmd in cmds:
+                key = self._cache_key(cmd)
+                found = False
+                if key is not None:
+                    found, cmd.result = self._cache.get(key)
+                if not found:
+                    missing.append(cmd)
+            cmds = missing
+        if not cmds:
+            return
+        results = cmds[0].receiver.task_batch([cmd.params for cmd in cmds])
+        if len(results) != len(cmds):
+            raise ValueError(
+                f'task_batch devolveu {len(results)} resultados para '
+                f'{len(cmds)} comandos'
+            )
+        for cmd, result in zip(cmds, results):
+            cmd.result = result
+            key = self._cache_key(cmd)
+            if key is not None:
+                self._cache.put(key, result)
+            
+    def _run(self, cmd: AbstractCommand) -> Any:
+        result = self._execute(cmd)
+        self._done(cmd)
+        return result
+            
+    def _execute(self, cmd: AbstractCommand) -> Any:
+        found, result = self._cached(cmd)
+        if not found:
+            result = cmd.execute()
+            self._executed(cmd, result)
+        return result
+    
+    def _cache_key(self, cmd: AbstractCommand) -> Optional[Hashable]:
+        '''
+        A chave de cache do comando, ou None se ele não pode usar o cache:
+        sem cache, comando não idempotente ou chave ausente ou não hasha-
+        ble. Nesses casos o comando simplesmente executa
+        '''
+        if self._cache is None or not cmd.idempotent:
+            return None
+        key = cmd.cache_key()
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+    
+    def _cached(self, cmd: AbstractCommand) -> Tuple[bool, Any]:
+        self._check(cmd)
+        key = self._cache_key(cmd)
+        if key is None:
+            return False, None
+        return self._cache.get(key)
+    
+    def _executed(self, cmd: AbstractCommand, result: Any) -> None:
+        key = self._cache_key(cmd)
+        if key is not None:
+            self._cache.put(key, result)
+        if self._history is not None \
+                and isinstance(cmd, AbstractUndoableCommand):
+            self._history.record(cmd)
+            
+    def _check(self, cmd: AbstractCommand) -> None:
+        '''
+        Comandos assíncronos só executam em invokers assíncronos: aqui a
+        corotina seria criada e descartada sem nunca rodar
+        '''
+        if not self.asynchronous and isinstance(cmd, AbstractAsyncCommand):
+            raise TypeError(
+                f'{type(cmd).__name__} é assíncrono; use o AsyncInvoker'
+            )
+
+
+class ParallelInvoker(Invoker):
+    '''
+    Esse invoker executa comandos independentes ao mesmo tempo, em um
+    pool de no máximo max_workers threads. Um comando só começa depois
+    que todas as suas dependências (da mesma lista) terminaram, ou seja,
+    a execução segue uma ordem topológica.
+    
+    A tarefa "protegida" continua esperando todos os comandos de before
+    terminarem, como no invoker original.
+    '''
+    
+    def __init__(self, max_workers: int = 8,
+                 journal: Optional[CommandJournal] = None,
+                 cache: Optional[ResultCache] = None,
+                 history: Optional[CommandHistory] = None) -> None:
+        super().__init__(journal, cache, history=history)
+        self._max_workers = max_workers
+        
+    @staticmethod
+    def _graph(cmds: List[AbstractCommand]) -> Tuple[
+            List[int], List[List[int]]]:
+        '''
+        Conta as dependências pendentes de cada posição da lista e lista
+        quem depende de quem. Um comando que aparece mais de uma vez é um
+        nó por posição, e depender dele é depender de todas elas. Depen-
+        dências fora da lista são ignoradas.
+        '''
+        positions : Dict[int, List[int]] = {}
+        for i, cmd in enumerate(cmds):
+            positions.setdefault(id(cmd), []).append(i)
+        pending = [0] * len(cmds)
+        dependents : List[List[int]] = [[] for _ in cmds]
+        for i, cmd in enumerate(cmds):
+            for dep in {id(dep) for dep in cmd.dependencies}:
+                for j in positions.get(dep, ()):
+                    pending[i] += 1
+                    dependents[j].append(i)
+        ready = [i for i, count in enumerate(pending) if not count]
+        done, check = 0, list(pending)
+        while ready:
+            i = ready.pop()
+            done += 1
+            for nxt in dependents[i]:
+                check[nxt] -= 1
+                if not check[nxt]:
+                    ready.append(nxt)
+        if done != len(cmds):
+            raise ValueError('Dependência circular entre os comandos')
+        return pending, dependents
+        
+    def _execute_all(self, cmds: List[AbstractCommand]) -> None:
+        pending, dependents = self._graph(cmds)
+        with ThreadPoolExecutor(self._max_workers) as pool:
+            running = {
+                pool.submit(self._run, cmd): i
+                for i, cmd in enumerate(cmds) if not pending[i]
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    future.result()
+                    for nxt in dependents[i]:
+                        pending[nxt] -= 1
+                        if not pending[nxt]:
+                            running[pool.submit(self._run, cmds[nxt])] = nxt
+
+
+class AsyncInvoker(ParallelInvoker):
+    '''
+    Versão assíncrona do invoker paralelo. Os comandos de cada lista ro-
+    dam como corotinas, no máximo max_workers ao mesmo tempo, e cada um
+    espera as suas dependências. Comandos assíncronos são aguardados no
+    próprio event loop; comandos síncronos podem ser misturados e rodam
+    em uma thread (asyncio.to_thread), para não travar o loop. Os dois
+    tipos passam pelo cache, pelo histórico e pelo journal.
+    '''
+    
+    asynchronous = True
+    
+    async def do_something_important(self) -> bool:
+        self._log_pending()
         if self._before:
-            for cmd in self._before:
-                cmd.execute()
+            await self._execute_all_async(self._before)
             self._before.clear()
         print('-- Invoker fazendo algo "protegido" --')
         if self._after:
-            for cmd in self._after:
-                cmd.execute()
+            await self._execute_all_async(self._after)
             self._after.clear()
         return True
+    
+    async def _execute_all_async(self, cmds: List[AbstractCommand]) -> None:
+        _, dependents = self._graph(cmds)
+        requires : List[List[int]] = [[] for _ in cmds]
+        for j, nxt in enumerate(dependents):
+            for i in nxt:
+                requires[i].append(j)
+        semaphore = asyncio.Semaphore(self._max_workers)
+        tasks : List[asyncio.Future] = []
+        
+        async def run(i: int, cmd: AbstractCommand) -> Any:
+            if requires[i]:
+                await asyncio.gather(*(tasks[j] for j in requires[i]))
+            async with semaphore:
+                if isinstance(cmd, AbstractAsyncCommand):
+                    return await self._run_async(cmd)
+                return await asyncio.to_thread(self._run, cmd)
+        
+        for i, cmd in enumerate(cmds):
+            tasks.append(asyncio.ensure_future(run(i, cmd)))
+        await asyncio.gather(*tasks)
+        
+    async def _run_async(self, cmd: AbstractAsyncCommand) -> Any:
+        '''
+        O mesmo que _run, aguardando a corotina do comando
+        '''
+        found, result = self._cached(cmd)
+        if not found:
+            result = await cmd.execute()
+            self._executed(cmd, result)
+        self._done(cmd)
+        return result
+
+
+class ScheduledCommand(AbstractCommand):
+    '''
+    Envelope de um comando agendado, com prioridade (maior executa an-
+    tes), prazo absoluto (time.monotonic) e ordem de chegada. Como tam-
+    bém é um comando, pode ser gravado no journal como qualquer outro.
+    '''
+    
+    def __init__(self, cmd: AbstractCommand, priority: int, deadline: float,
+                 seq: int) -> None:
+        self.command = cmd
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = monotonic()
+        self.cancelled = False
+        self.late = False
+        self.owner : Optional[SchedulingInvoker] = None
+        self._key = (-priority, deadline, seq)
+        
+    def __lt__(self, other: ScheduledCommand) -> bool:
+        return self._key < other._key
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        '''
+        O invoker dono da fila não vai para o journal
+        '''
+        return {**self.__dict__, 'owner': None}
+    
+    def execute(self) -> Any:
+        return self.command.execute()
+
+
+class SchedulingInvoker(Invoker):
+    '''
+    Invoker em que as listas before e after são filas de prioridade (he-
+    aps). Os comandos saem por prioridade, depois pelo prazo mais curto
+    e por fim pela ordem de chegada. Um comando que perdeu o prazo é
+    descartado (on_miss='drop') ou executado e marcado como atrasado
+    (on_miss='flag'); em ambos os casos vai para a lista missed.
+    
+    Comandos agendados podem ser cancelados antes de executar. As métri-
+    cas incluem a profundidade da fila e o tempo de espera na fila.
+    '''
+    
+    _before : List[ScheduledCommand]
+    _after : List[ScheduledCommand]
+    
+    def __init__(self, on_miss: str = 'drop',
+                 journal: Optional[CommandJournal] = None,
+                 cache: Optional[ResultCache] = None) -> None:
+        if on_miss not in ('drop', 'flag'):
+            raise ValueError("on_miss deve ser 'drop' ou 'flag'")
+        super().__init__(journal, cache)
+        self._on_miss = on_miss
+        self._seq = 0
+        self._depth = 0
+        self.missed : List[ScheduledCommand] = []
+        self.executed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        
+    def _schedule(self, queue: List[ScheduledCommand], cmd: AbstractCommand,
+                  priority: int, deadline: Optional[float]
+                  ) -> ScheduledCommand:
+        '''
+        deadline é o prazo, em segundos a partir de agora
+        '''
+        self._check(cmd)
+        self._seq += 1
+        expires = float('inf') if deadline is None else monotonic() + deadline
+        entry = ScheduledCommand(cmd, priority, expires, self._seq)
+        entry.owner = self
+        heapq.heappush(queue, entry)
+        self._depth += 1
+        return entry
+        
+    def append_command_before(self, cmd: AbstractCommand, priority: int = 0,
+                              deadline: Optional[float] = None
+                              ) -> ScheduledCommand:
+        return self._schedule(self._before, cmd, priority, deadline)
+        
+    def append_command_after(self, cmd: AbstractCommand, priority: int = 0,
+                             deadline: Optional[float] = None
+                             ) -> ScheduledCommand:
+        return self._schedule(self._after, cmd, priority, deadline)
+    
+    def cancel(self, entry: ScheduledCommand) -> bool:
+        '''
+        Cancela um comando ainda na fila. Ele só é removido do heap quan-
+        do chegar ao topo (remoção preguiçosa); até lá, owner indica em
+        que invoker ele está, sem busca na fila.
+        '''
+        if entry.cancelled or entry.owner is not self:
+            return False
+        entry.cancelled = True
+        self._depth -= 1
+        return True
+    
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+    
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self._depth,
+            'executed': self.executed,
+            'missed': len(self.missed),
+            'wait_avg': self.wait_total / self.executed if self.executed
+                        else 0.0,
+            'wait_max': self.wait_max,
+        }
+        
+    def _log_pending(self) -> None:
+        '''
+        Só grava no journal o que ainda pode executar: comandos cancela-
+        dos e, com on_miss='drop', os que já perderam o prazo ficam de
+        fora
+        '''
+        if self._journal is None:
+            return
+        now = monotonic()
+        for entry in self._before + self._after:
+            if entry.cancelled or (self._on_miss == 'drop'
+                                   and now > entry.deadline):
+                continue
+            self._track(entry.command, self._journal.append(entry))
+        self._journal.commit()
+        
+    def _execute_all(self, queue: List[ScheduledCommand]) -> None:
+        while queue:
+            entry = heapq.heappop(queue)
+            entry.owner = None
+            if entry.cancelled:
+                self._done(entry.command)
+                continue
+            self._depth -= 1
+            now = monotonic()
+            if now > entry.deadline:
+                entry.late = True
+                self.missed.append(entry)
+                if self._on_miss == 'drop':
+                    self._done(entry.command)
+                    continue
+            waited = now - entry.enqueued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.executed += 1
+            self._run(entry.command)
 
 # Testes
 def command_tests() -> bool:    
@@ -92,10 +1039,381 @@ def command_tests() -> bool:
     ivk.append_command_after(ComplexCommand(receiver=rcv))                             
     return ivk.do_something_important()
 
+class SleepCommand(AbstractCommand):
+    '''
+    Comando de teste que simula espera por I/O e registra quando acabou
+    '''
+    
+    def __init__(self, name: str, log: List[str],
+                 delay: float = 0.05) -> None:
+        self._name, self._log, self._delay = name, log, delay
+        
+    def execute(self) -> None:
+        sleep(self._delay)
+        self._log.append(self._name)
+
+def parallel_invoker_tests() -> bool:
+    log : List[str] = []
+    ivk = ParallelInvoker(max_workers=8)
+    first = SleepCommand('first', log)
+    middle = [
+        SleepCommand(f'middle{i}', log).depends_on(first) for i in range(6)
+    ]
+    last = SleepCommand('last', log).depends_on(*middle)
+    for cmd in [last, *middle, first]:
+        ivk.append_command_before(cmd)
+    ivk.append_command_after(SimpleCommand())
+    start = perf_counter()
+    assert(ivk.do_something_important())
+    assert(perf_counter() - start < 0.05 * 8)
+    assert(log[0] == 'first' and log[-1] == 'last' and len(log) == 8)
+    twice = SleepCommand('twice', log, 0)
+    after = SleepCommand('after', log, 0).depends_on(twice)
+    ParallelInvoker()._execute_all([twice, after, twice])
+    assert(log[-3:] == ['twice', 'twice', 'after'])
+    a, b = SleepCommand('a', log), SleepCommand('b', log)
+    a.depends_on(b)
+    b.depends_on(a)
+    try:
+        ParallelInvoker()._execute_all([a, b])
+    except ValueError:
+        return True
+    return False
+
+    
+def journal_tests() -> bool:
+    fd, path = mkstemp(suffix='.wal')
+    os.close(fd)
+    journal = CommandJournal(path)
+    ivk, rcv = Invoker(journal=journal), Receiver()
+    for foo in ('a', 'b', 'c'):
+        ivk.append_command_before(SimpleCommand(foo))
+    ivk.append_command_after(ComplexCommand(receiver=rcv))
+    ivk.do_something_important()
+    assert(journal.commits == 1 and len(journal) == 0)
+    for foo in ('d', 'e', 'f'):
+        ivk.append_command_before(SimpleCommand(foo))
+    ivk.append_command_after(ComplexCommand(receiver=rcv))
+    ivk._log_pending()
+    ivk._run(ivk._before[1])
+    journal.close()
+    with open(path, 'ab') as file:
+        file.write(CommandJournal.RECORD.pack(1000, 0, 0, 99) + b'incompleto')
+    cmds = CommandJournal.replay(path)
+    assert([type(cmd) for cmd in cmds] == [SimpleCommand] * 2 + [ComplexCommand])
+    assert([cmd._foo for cmd in cmds[:2]] == ['d', 'f'])
+    journal = CommandJournal(path, checkpoint_bytes=0)
+    assert(len(journal) == 3)
+    journal.checkpoint()
+    assert(len(CommandJournal._records(path)[0]) == 3)
+    assert([cmd._foo for cmd in CommandJournal.replay(path)[:2]] == ['d', 'f'])
+    for seq in list(journal._open):
+        journal.complete(seq)
+    journal.close()
+    size = os.path.getsize(path)
+    assert(size == 0)
+    journal = CommandJournal(path)
+    journal.append(SimpleCommand('a'))
+    journal.close()
+    with open(path, 'ab') as file:
+        file.write(CommandJournal.RECORD.pack(1000, 0, 0, 99) + b'rasgado')
+    journal = CommandJournal(path)
+    journal.append(SimpleCommand('b'))
+    journal.close()
+    replayed = [cmd._foo for cmd in CommandJournal.replay(path)]
+    os.remove(path)
+    assert(replayed == ['a', 'b'])
+    return True
+    
+class CountingReceiver(Receiver):
+    '''
+    Receiver de teste que conta quantas vezes realmente trabalhou
+    '''
+    
+    def __init__(self) -> None:
+        self.calls = 0
+        
+    def task(self, params: list) -> int:
+        self.calls += 1
+        return sum(params)
+    
+    def task_batch(self, batch: List[list]) -> List[int]:
+        self.calls += 1
+        return [sum(params) for params in batch]
+
+class IdempotentCommand(ComplexCommand):
+    '''
+    ComplexCommand de teste que declara ser idempotente
+    '''
+    
+    idempotent = True
+
+def cache_tests() -> bool:
+    cache = ResultCache(maxsize=2)
+    ivk, rcv = Invoker(cache=cache), CountingReceiver()
+    for params in ([1], [2], [1], [1], [3], [2]):
+        ivk.append_command_before(IdempotentCommand(rcv, params))
+    ivk.append_command_after(SimpleCommand())
+    ivk.do_something_important()
+    assert(rcv.calls == 4)
+    assert(cache.stats == {'hits': 2, 'misses': 4, 'evictions': 2,
+                           'size': 2})
+    cache = ResultCache(ttl=0.0)
+    cache.put('k', 1)
+    assert(cache.get('k') == (False, None) and cache.evictions == 1)
+    
+    class NestedReceiver(CountingReceiver):
+        def task(self, params: list) -> int:
+            self.calls += 1
+            return len(params)
+    
+    cache, rcv = ResultCache(), NestedReceiver()
+    ivk = Invoker(cache=cache)
+    for cmd in (ComplexCommand(rcv, [1]), ComplexCommand(rcv, [1]),
+                IdempotentCommand(rcv, [[1], [2]]),
+                IdempotentCommand(rcv, [[1], [2]])):
+        ivk.append_command_before(cmd)
+    ivk.do_something_important()
+    assert(rcv.calls == 3 and cache.hits == 1)
+    unhashable = IdempotentCommand(rcv, [1])
+    unhashable.cache_key = lambda: [1]
+    ivk.append_command_before(unhashable)
+    ivk.do_something_important()
+    assert(rcv.calls == 4 and len(cache) == 1)
+    return True
+    
+def batch_tests() -> bool:
+    ivk = Invoker(batch=True)
+    rcv1, rcv2 = CountingReceiver(), CountingReceiver()
+    cmds = [
+        ComplexCommand(rcv1 if i % 3 else rcv2, [i, i])
+        for i in range(1000)
+    ]
+    for cmd in cmds:
+        ivk.append_command_before(cmd)
+    ivk.append_command_before(SimpleCommand())
+    ivk.do_something_important()
+    assert(rcv1.calls == 1 and rcv2.calls == 1)
+    assert(all(cmd.result == 2 * i for i, cmd in enumerate(cmds)))
+    cache = ResultCache()
+    ivk = Invoker(cache=cache, batch=True)
+    for params in ([1], [2], [1]):
+        ivk.append_command_after(IdempotentCommand(rcv1, params))
+    ivk.do_something_important()
+    ivk.append_command_after(IdempotentCommand(rcv1, [2]))
+    ivk.do_something_important()
+    assert(rcv1.calls == 2 and cache.hits == 1)
+    log : List[str] = []
+    
+    class LoggedCommand(ComplexCommand):
+        def execute(self) -> Any:
+            log.append('logged')
+            return super().execute()
+    
+    class LoggedReceiver(CountingReceiver):
+        def task_batch(self, batch: List[list]) -> List[int]:
+            log.append(f'batch{len(batch)}')
+            return super().task_batch(batch)
+    
+    rcv = LoggedReceiver()
+    ivk = Invoker(batch=True)
+    for cmd in (ComplexCommand(rcv, [1]), ComplexCommand(rcv, [2]),
+                SleepCommand('simple', log, 0), LoggedCommand(rcv, [3]),
+                ComplexCommand(rcv, [4])):
+        ivk.append_command_before(cmd)
+    ivk.do_something_important()
+    assert(log == ['batch2', 'simple', 'logged', 'batch1'])
+    
+    class ShortReceiver(Receiver):
+        def task_batch(self, batch: List[list]) -> List[Any]:
+            return []
+    
+    ivk = Invoker(batch=True)
+    ivk.append_command_before(ComplexCommand(ShortReceiver()))
+    try:
+        ivk.do_something_important()
+    except ValueError:
+        return True
+    return False
+    
+class CancelCommand(AbstractCommand):
+    '''
+    Comando de teste que cancela uma entrada de um SchedulingInvoker
+    '''
+    
+    def __init__(self, ivk: SchedulingInvoker,
+                 entry: ScheduledCommand) -> None:
+        self._ivk, self._entry = ivk, entry
+        
+    def execute(self) -> None:
+        self._ivk.cancel(self._entry)
+        
+    def __getstate__(self) -> Dict[str, Any]:
+        return {}
+
+def scheduling_tests() -> bool:
+    log : List[str] = []
+    ivk = SchedulingInvoker()
+    ivk.append_command_before(SleepCommand('low', log, 0), priority=0)
+    ivk.append_command_before(SleepCommand('high', log, 0), priority=5)
+    late = ivk.append_command_before(SleepCommand('late', log, 0),
+                                     priority=9, deadline=-1.0)
+    soon = ivk.append_command_before(SleepCommand('soon', log, 0),
+                                     priority=5, deadline=10.0)
+    gone = ivk.append_command_after(SleepCommand('gone', log, 0))
+    ivk.append_command_after(SleepCommand('after', log, 0))
+    assert(ivk.cancel(gone) and not ivk.cancel(gone))
+    assert(ivk.queue_depth == 5)
+    ivk.do_something_important()
+    assert(log == ['soon', 'high', 'low', 'after'])
+    assert(ivk.missed == [late] and late.late and not soon.late)
+    assert(ivk.stats['executed'] == 4 and ivk.queue_depth == 0)
+    ivk = SchedulingInvoker(on_miss='flag')
+    ivk.append_command_before(SleepCommand('late', log, 0), deadline=-1.0)
+    ivk.do_something_important()
+    assert(log[-1] == 'late' and len(ivk.missed) == 1)
+    assert(not ivk.cancel(ivk.missed[0]) and not SchedulingInvoker().cancel(late))
+    fd, path = mkstemp(suffix='.wal')
+    os.close(fd)
+    journal = CommandJournal(path)
+    ivk = SchedulingInvoker(journal=journal)
+    ivk.append_command_before(SleepCommand('ok', log, 0))
+    ivk.cancel(ivk.append_command_before(SleepCommand('cancelado', log, 0)))
+    ivk.append_command_before(SleepCommand('atrasado', log, 0), deadline=-1.0)
+    ivk._log_pending()
+    journal.close()
+    cmds = CommandJournal.replay(path)
+    os.remove(path)
+    assert([cmd.command._name for cmd in cmds] == ['ok'])
+    journal = CommandJournal(path)
+    ivk = SchedulingInvoker(journal=journal)
+    gone = ivk.append_command_after(SleepCommand('cancelado', log, 0))
+    ivk.append_command_before(CancelCommand(ivk, gone))
+    ivk.do_something_important()
+    journal.close()
+    cmds = CommandJournal.replay(path)
+    os.remove(path)
+    assert(gone.cancelled and cmds == [])
+    return True
+    
+def history_tests() -> bool:
+    rcv = StatefulReceiver()
+    history = CommandHistory(rcv, snapshot_every=10)
+    ivk = Invoker(history=history)
+    states = [rcv.snapshot()]
+    for i in range(100):
+        ivk.append_command_before(SetCommand(rcv, i % 7, i))
+        ivk.do_something_important()
+        states.append(rcv.snapshot())
+    assert(history.undo() and rcv.state == states[99])
+    assert(history.redo() and rcv.state == states[100])
+    for target in (3, 57, 0, 100, 42):
+        history.goto(target)
+        assert(rcv.state == states[target])
+    ivk.append_command_before(SetCommand(rcv, 'novo', 1))
+    ivk.do_something_important()
+    assert(history.last == 43 and not history.redo())
+    history = CommandHistory(rcv, snapshot_every=10, max_bytes=8 * 2**10)
+    for i in range(1000):
+        cmd = SetCommand(rcv, i % 7, i)
+        cmd.execute()
+        history.record(cmd)
+    assert(history.bytes <= 8 * 2**10 and history.first > 0)
+    while history.undo():
+        pass
+    assert(history.position == history.first)
+    return True
+    
+class AsyncSleepCommand(AbstractAsyncCommand):
+    '''
+    Versão assíncrona do SleepCommand
+    '''
+    
+    def __init__(self, name: str, log: List[str],
+                 delay: float = 0.05) -> None:
+        self._name, self._log, self._delay = name, log, delay
+        
+    async def execute(self) -> None:
+        await asyncio.sleep(self._delay)
+        self._log.append(self._name)
+
+class AsyncSetCommand(AbstractAsyncCommand, SetCommand):
+    '''
+    Versão assíncrona do SetCommand, que também pode ser desfeita
+    '''
+    
+    async def execute(self) -> None:
+        SetCommand.execute(self)
+
+class CountingAsyncReceiver(AsyncReceiver):
+    '''
+    Versão assíncrona do CountingReceiver
+    '''
+    
+    def __init__(self) -> None:
+        super().__init__(0)
+        self.calls = 0
+        
+    async def task(self, params: list) -> int:
+        self.calls += 1
+        return sum(params)
+
+def async_invoker_tests() -> bool:
+    log : List[str] = []
+    ivk = AsyncInvoker(max_workers=10)
+    first = AsyncSleepCommand('first', log)
+    middle = [
+        AsyncSleepCommand(f'middle{i}', log).depends_on(first)
+        for i in range(19)
+    ]
+    mixed = SleepCommand('sync', log).depends_on(first)
+    last = AsyncSleepCommand('last', log).depends_on(*middle, mixed)
+    for cmd in [last, mixed, *middle, first]:
+        ivk.append_command_before(cmd)
+    ivk.append_command_after(AsyncComplexCommand(AsyncReceiver()))
+    start = perf_counter()
+    assert(asyncio.run(ivk.do_something_important()))
+    assert(perf_counter() - start < 0.05 * 10)
+    assert(log[0] == 'first' and log[-1] == 'last' and len(log) == 22)
+    twice = AsyncSleepCommand('twice', log, 0)
+    asyncio.run(ivk._execute_all_async([twice, twice]))
+    assert(log[-2:] == ['twice', 'twice'])
+    for sync in (Invoker(), ParallelInvoker(), SchedulingInvoker()):
+        try:
+            sync.append_command_before(twice)
+        except TypeError:
+            continue
+        return False
+    rcv = CountingAsyncReceiver()
+    cache = ResultCache()
+    ivk = AsyncInvoker(cache=cache)
+    for params in ([1], [2], [1]):
+        cmd = AsyncComplexCommand(rcv, params)
+        cmd.idempotent = True
+        ivk.append_command_before(cmd)
+    asyncio.run(ivk.do_something_important())
+    assert(rcv.calls == 2 and cache.hits == 1)
+    state = StatefulReceiver()
+    history = CommandHistory(state)
+    ivk = AsyncInvoker(history=history)
+    ivk.append_command_before(SetCommand(state, 'sync', 1))
+    asyncio.run(ivk.do_something_important())
+    ivk.append_command_before(AsyncSetCommand(state, 'async', 2))
+    asyncio.run(ivk.do_something_important())
+    assert(state.state == {'sync': 1, 'async': 2} and history.last == 2)
+    assert(history.undo() and state.state == {'sync': 1})
+    return True
     
 # Main
 def main() -> None:
     assert(command_tests())
+    assert(parallel_invoker_tests())
+    assert(journal_tests())
+    assert(cache_tests())
+    assert(batch_tests())
+    assert(scheduling_tests())
+    assert(history_tests())
+    assert(async_invoker_tests())
     
 if __name__ == "__main__":
     main()
@@ -6,9 +6,27 @@ Data: 18/11/2024
 """
 
 from __future__ import annotations
+import asyncio
+import os
+import sys
+import tracemalloc
 from abc import ABC, abstractmethod
-from random import randrange
-from typing import List
+from array import array
+from collections import deque
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+)
+from inspect import isawaitable
+from multiprocessing import Process, Queue
+from operator import itemgetter
+from random import choice, randrange
+from socket import socket, AF_UNIX, SOCK_STREAM, SHUT_RDWR
+from struct import Struct
+from tempfile import mkdtemp
+from threading import Condition, Event, Lock, RLock, Thread, Timer
+from time import monotonic, perf_counter, sleep
+from typing import Deque, Dict, Hashable, List, Optional, Tuple, Union
+from weakref import ref, ReferenceType
 
 
 class AbstractSubject(ABC):
@@ -32,31 +50,384 @@ class AbstractSubject(ABC):
         pass    
 
 
+Handle = Union['AbstractObserver', ReferenceType]
+
+
+class ObserverRegistry:
+    '''
+    Registro indexado de observadores. Cada observador é guardado em um
+    dicionário pelo seu id, então attach e dettach custam O(1), e a or-
+    dem de inscrição é preservada na entrega.
+    
+    Um observador pode se inscrever em um tópico (topic) e/ou em uma fa-
+    ixa de estados (states, um range). Cada tópico tem um índice com os
+    observadores sem faixa e um balde por valor de estado, onde ficam
+    os observadores cuja faixa contém o valor. Assim a busca lê só os
+    grupos que combinam com o estado, sem varrer as faixas. Faixas com
+    mais de BUCKET_LIMIT valores ficam de fora dos baldes e são testa-
+    das uma a uma. Quem não define tópico nem faixa recebe todas as no-
+    tificações. O resultado de cada busca (estado, tópico) fica guardado
+    até a próxima inscrição ou remoção.
+    
+    Com weak=True o registro guarda apenas referências fracas. Um obser-
+    vador esquecido (sem dettach) é removido pelo callback da própria
+    referência quando é coletado, em O(1), sem varredura no notify.
+    '''
+    
+    BUCKET_LIMIT = 1024
+    CACHE_SIZE = 1024
+    
+    Group = Dict[int, Tuple[int, Handle]]
+    
+    __entries : Dict[int, Tuple[int, Handle, Hashable, Optional[range]]]
+    __index : Dict[Hashable, Tuple[Group, Dict[int, Group],
+                                   Dict[range, Group]]]
+    
+    def __init__(self, weak: bool = False) -> None:
+        self.__entries = {}
+        self.__index = {}
+        self.__matches : Dict[Tuple[int, Hashable], List[Handle]] = {}
+        self.__seq = 0
+        self.__weak = weak
+        
+    def __len__(self) -> int:
+        return len(self.__entries)
+    
+    def __contains__(self, obs: AbstractObserver) -> bool:
+        return id(obs) in self.__entries
+        
+    def add(self, obs: AbstractObserver, topic: Hashable = None,
+            states: Optional[range] = None) -> None:
+        key = id(obs)
+        if key in self.__entries:
+            self.remove(obs)
+        if self.__weak:
+            handle = ref(obs, lambda _, key=key: self.__discard(key))
+        else:
+            handle = obs
+        self.__matches.clear()
+        self.__seq += 1
+        item = (self.__seq, handle)
+        self.__entries[key] = (self.__seq, handle, topic, states)
+        every, buckets, wide = self.__index.setdefault(topic, ({}, {}, {}))
+        if states is None:
+            every[key] = item
+        elif len(states) <= self.BUCKET_LIMIT:
+            for value in states:
+                buckets.setdefault(value, {})[key] = item
+        else:
+            wide.setdefault(states, {})[key] = item
+        
+    def remove(self, obs: AbstractObserver) -> None:
+        if not self.__discard(id(obs)):
+            raise ValueError('Observador não está inscrito')
+        
+    def __discard(self, key: int) -> bool:
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return False
+        self.__matches.clear()
+        _, _, topic, states = entry
+        every, buckets, wide = self.__index[topic]
+        if states is None:
+            del every[key]
+        elif len(states) <= self.BUCKET_LIMIT:
+            for value in states:
+                bucket = buckets[value]
+                del bucket[key]
+                if not bucket:
+                    del buckets[value]
+        else:
+            group = wide[states]
+            del group[key]
+            if not group:
+                del wide[states]
+        if not (every or buckets or wide):
+            del self.__index[topic]
+        return True
+                
+    def match(self, state: int,
+              topic: Hashable = None) -> List[AbstractObserver]:
+        '''
+        Retorna, na ordem de inscrição, os observadores interessados no
+        estado e no tópico notificados
+        '''
+        handles = self.__matches.get((state, topic))
+        if handles is None:
+            handles = self.__lookup(state, topic)
+            if len(self.__matches) >= self.CACHE_SIZE:
+                self.__matches.clear()
+            self.__matches[(state, topic)] = handles
+        if not self.__weak:
+            return list(handles)
+        return [obs for obs in (h() for h in handles) if obs is not None]
+    
+    def __lookup(self, state: int, topic: Hashable) -> List[Handle]:
+        '''
+        Cada grupo já está em ordem de inscrição. Com vários grupos, o
+        sort estável do Python encontra essas sequências já ordenadas e
+        só as intercala, em tempo linear
+        '''
+        groups = []
+        for t in ((None,) if topic is None else (None, topic)):
+            index = self.__index.get(t)
+            if index is None:
+                continue
+            every, buckets, wide = index
+            if every:
+                groups.append(every)
+            bucket = buckets.get(state)
+            if bucket:
+                groups.append(bucket)
+            for states, group in wide.items():
+                if state in states:
+                    groups.append(group)
+        if len(groups) == 1:
+            return [handle for _, handle in groups[0].values()]
+        items = [item for group in groups for item in group.values()]
+        items.sort(key=itemgetter(0))
+        return [handle for _, handle in items]
+
+
+class StateSnapshot:
+    '''
+    Cópia imutável do estado do sujeito no momento da notificação. Os
+    dispatchers em paralelo entregam o snapshot no lugar do sujeito, já
+    que o estado real pode mudar antes do observador reagir.
+    '''
+    
+    __slots__ = ('state', 'changes')
+    
+    def __init__(self, state: int, changes: Tuple[int, ...] = ()) -> None:
+        self.state = state
+        self.changes = changes
+        
+    def snapshot(self) -> StateSnapshot:
+        return self
+
+
+def _deliver(obs: AbstractObserver, sbj: StateSnapshot) -> None:
+    '''
+    Função de módulo (e não lambda) para poder ser enviada a outro pro-
+    cesso pelo ProcessPoolExecutor
+    '''
+    obs.update(sbj)
+
+
+class AbstractDispatcher(ABC):
+    '''
+    O dispatcher decide como o sujeito entrega uma notificação aos ob-
+    servadores selecionados. Trocar o dispatcher não muda o sujeito nem
+    os observadores (padrão Strategy).
+    '''
+    
+    @abstractmethod
+    def dispatch(self, observers: List[AbstractObserver],
+                 sbj: Subject) -> None:
+        pass
+    
+    def join(self) -> None:
+        '''
+        Espera até que todas as notificações enviadas sejam entregues
+        '''
+        pass
+    
+    def shutdown(self) -> None:
+        self.join()
+
+
+class InlineDispatcher(AbstractDispatcher):
+    '''
+    O dispatcher padrão: chama cada observador em sequência, na thread
+    do sujeito
+    '''
+    
+    def dispatch(self, observers: List[AbstractObserver],
+                 sbj: Subject) -> None:
+        for obs in observers:
+            obs.update(sbj)
+
+
+class PoolDispatcher(AbstractDispatcher):
+    '''
+    Entrega as notificações em um pool de execução. Observadores dife-
+    rentes reagem em paralelo, mas cada observador tem sua fila: a pró-
+    xima notificação dele só é enviada ao pool quando a anterior termi-
+    na, então um mesmo observador sempre vê os estados em ordem.
+    
+    Exceções dos observadores são guardadas em errors.
+    '''
+    
+    _queues : Dict[int, Deque[StateSnapshot]]
+    
+    def __init__(self, executor: Executor) -> None:
+        self._executor = executor
+        self._queues = {}
+        self._idle = Condition(RLock())
+        self.errors : List[BaseException] = []
+        
+    def dispatch(self, observers: List[AbstractObserver],
+                 sbj: Subject) -> None:
+        snapshot = sbj.snapshot()
+        with self._idle:
+            for obs in observers:
+                queue = self._queues.get(id(obs))
+                if queue is None:
+                    self._queues[id(obs)] = deque()
+                    self._submit(obs, snapshot)
+                else:
+                    queue.append(snapshot)
+                    
+    def _submit(self, obs: AbstractObserver, snapshot: StateSnapshot) -> None:
+        future = self._executor.submit(_deliver, obs, snapshot)
+        future.add_done_callback(lambda f: self._next(obs, f))
+        
+    def _next(self, obs: AbstractObserver, future: Future) -> None:
+        with self._idle:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            queue = self._queues[id(obs)]
+            if queue:
+                self._submit(obs, queue.popleft())
+            else:
+                del self._queues[id(obs)]
+                if not self._queues:
+                    self._idle.notify_all()
+                    
+    def join(self) -> None:
+        with self._idle:
+            self._idle.wait_for(lambda: not self._queues)
+            
+    def shutdown(self) -> None:
+        self.join()
+        self._executor.shutdown()
+
+
+class ThreadPoolDispatcher(PoolDispatcher):
+    '''
+    Bom para observadores que esperam por I/O
+    '''
+    
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        super().__init__(ThreadPoolExecutor(max_workers))
+
+
+class ProcessPoolDispatcher(PoolDispatcher):
+    '''
+    Para reações pesadas de CPU, que não escalam em threads por causa
+    do GIL. Os observadores são copiados (pickle) para os processos a
+    cada entrega, então o estado que eles acumulam lá não volta para o
+    processo do sujeito.
+    '''
+    
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        super().__init__(ProcessPoolExecutor(max_workers))
+
+
+class StateHistory:
+    '''
+    Buffer circular com os estados mais recentes do sujeito, guardados
+    em um array de inteiros de tamanho fixo (capacity). Cada estado re-
+    cebe um número de sequência crescente, começando em 1. Quando o bu-
+    ffer enche, o estado mais antigo é sobrescrito.
+    '''
+    
+    __states : array
+    
+    def __init__(self, capacity: int = 1024) -> None:
+        if capacity < 1:
+            raise ValueError('capacity deve ser ao menos 1')
+        self.__states = array('q', bytes(8 * capacity))
+        self.__capacity = capacity
+        self.__next_seq = 1
+        
+    def __len__(self) -> int:
+        return self.__next_seq - self.first_seq
+        
+    @property
+    def first_seq(self) -> int:
+        return max(1, self.__next_seq - self.__capacity)
+    
+    @property
+    def last_seq(self) -> int:
+        return self.__next_seq - 1
+    
+    def append(self, state: int) -> int:
+        seq = self.__next_seq
+        self.__states[seq % self.__capacity] = state
+        self.__next_seq += 1
+        return seq
+    
+    def since(self, seq: int) -> Tuple[int, array]:
+        '''
+        Retorna a sequência do primeiro estado e os estados a partir de
+        seq (inclusive), em uma única cópia. Se seq já foi sobrescrito,
+        a resposta começa no mais antigo disponível, e quem pediu perce-
+        be a lacuna comparando as sequências.
+        '''
+        start, stop = max(seq, self.first_seq), self.__next_seq
+        if start >= stop:
+            return stop, array('q')
+        i, j = start % self.__capacity, stop % self.__capacity
+        if i < j:
+            return start, self.__states[i:j]
+        return start, self.__states[i:] + self.__states[:j]
+
+
 class Subject(AbstractSubject):
     '''
     A versão concreta de um sujeito deve definir como os métodos funcio-
-    nam. Aqui, os observadores são armazenados em uma lista, e o estado
-    do sujeito é apenas um número.
+    nam. Aqui, os observadores são armazenados em um registro indexado,
+    e o estado do sujeito é apenas um número.
+    
+    Com weak=True, o sujeito não mantém seus observadores vivos: quem
+    não for mais referenciado em outro lugar deixa de ser notificado. A
+    forma de entrega das notificações é definida pelo dispatcher.
+    
+    Com history > 0, os últimos estados ficam em um StateHistory. Um ob-
+    servador que entra (ou volta) pode pedir, no attach, os estados a
+    partir de uma sequência (since) e recebe todos em uma chamada só de
+    catch_up, ao invés de reconstruir seu estado do zero.
     '''
     
-    __observers : List[AbstractObserver]
+    __observers : ObserverRegistry
     __state : int
+    __history : Optional[StateHistory]
     
-    def __init__(self) -> None:
-        self.__observers = []
+    def __init__(self, weak: bool = False,
+                 dispatcher: Optional[AbstractDispatcher] = None,
+                 history: int = 0) -> None:
+        self.__observers = ObserverRegistry(weak)
         self.__state = 0
+        self.__dispatcher = dispatcher or InlineDispatcher()
+        self.__history = StateHistory(history) if history else None
         
-    def attach(self, obs: AbstractObserver) -> None:
-        self.__observers.append(obs)
+    def attach(self, obs: AbstractObserver, topic: Hashable = None,
+               states: Optional[range] = None,
+               since: Optional[int] = None) -> None:
+        if since is not None:
+            if self.__history is None:
+                raise ValueError('Sujeito criado sem histórico')
+            obs.catch_up(self, *self.__history.since(since))
+        self.__observers.add(obs, topic, states)
         
     def dettach(self, obs):
         return self.__observers.remove(obs)
     
-    def notify(self) -> None:
-        for obs in self.__observers:
-            obs.update(self)
+    def notify(self, topic: Hashable = None) -> None:
+        self._dispatch(self.__state, topic, self)
+        
+    def _dispatch(self, state: int, topic: Hashable,
+                  sbj: Union[Subject, StateSnapshot]) -> None:
+        '''
+        Entrega sbj aos observadores do tópico interessados em state
+        '''
+        self.__dispatcher.dispatch(self.__observers.match(state, topic), sbj)
+        
+    def snapshot(self) -> StateSnapshot:
+        return StateSnapshot(self.__state)
             
-    def task(self) -> None:
+    def task(self, topic: Hashable = None) -> None:
         '''
         Dificilmente o padrão Observer é a totalidade da classe sujeito.
         Na prática, ela também realiza tarefas, integrada ao software
@@ -64,13 +435,95 @@ class Subject(AbstractSubject):
         servadores (sistema push)
         '''
         self.__state = randrange(0, 10)
-        self.notify()
+        if self.__history is not None:
+            self.__history.append(self.__state)
+        self.notify(topic)
         
     @property
     def state(self) -> int:
         return self.__state
+    
+    @property
+    def seq(self) -> int:
+        '''
+        Sequência do estado atual no histórico (0 sem histórico)
+        '''
+        return self.__history.last_seq if self.__history else 0
  
 
+class CoalescingSubject(Subject):
+    '''
+    Quando o estado muda muitas vezes por segundo, os observadores rea-
+    gem a estados intermediários que ninguém precisa. Esse sujeito acu-
+    mula as mudanças e notifica uma só vez por janela de tempo (window)
+    ou quando o lote atinge max_batch mudanças.
+    
+    Cada tópico é entregue como um StateSnapshot próprio: sbj.state é o
+    estado mais recente daquele tópico, que também é o usado para esco-
+    lher os observadores por faixa, e sbj.changes traz o lote compacto
+    de mudanças acumuladas, para quem precisar de todas.
+    
+    Por padrão não há thread de temporização: a janela é verificada a
+    cada mudança, então as últimas mudanças de uma rajada só são entre-
+    gues na próxima mudança ou com uma chamada explícita de flush. Com
+    autoflush=True, um timer entrega o que estiver pendente ao fim da
+    janela, em outra thread.
+    '''
+    
+    __pending : Dict[Hashable, List[int]]
+    
+    def __init__(self, window: float = 0.05, max_batch: int = 100,
+                 weak: bool = False,
+                 dispatcher: Optional[AbstractDispatcher] = None,
+                 history: int = 0, autoflush: bool = False) -> None:
+        super().__init__(weak, dispatcher, history)
+        self.__window = window
+        self.__max_batch = max_batch
+        self.__autoflush = autoflush
+        self.__pending = {}
+        self.__since = None
+        self.__timer : Optional[Timer] = None
+        self.__lock = Lock()
+        self.delivered = 0
+        self.saved = 0
+        
+    def notify(self, topic: Hashable = None) -> None:
+        '''
+        Acumula a mudança. Sem autoflush, o que ficar pendente ao fim de
+        uma rajada só é entregue por flush
+        '''
+        with self.__lock:
+            pending = self.__pending.setdefault(topic, [])
+            pending.append(self.state)
+            now = monotonic()
+            if self.__since is None:
+                self.__since = now
+                if self.__autoflush:
+                    self.__timer = Timer(self.__window, self.flush)
+                    self.__timer.daemon = True
+                    self.__timer.start()
+            due = (len(pending) >= self.__max_batch
+                   or now - self.__since >= self.__window)
+        if due:
+            self.flush()
+            
+    def flush(self) -> None:
+        '''
+        Entrega as mudanças pendentes, uma notificação por tópico
+        '''
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+            self.__since = None
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+        for topic, changes in pending.items():
+            self.delivered += 1
+            self.saved += len(changes) - 1
+            self._dispatch(changes[-1], topic,
+                           StateSnapshot(changes[-1], tuple(changes)))
+
+
 class AbstractObserver(ABC):
     '''
     A interface de observadores requer apenas a declaração de uma reação
@@ -80,6 +533,15 @@ class AbstractObserver(ABC):
     @abstractmethod
     def update(self, sbj: AbstractSubject):
         pass
+    
+    def catch_up(self, sbj: AbstractSubject, first_seq: int,
+                 states: array) -> None:
+        '''
+        Recebe de uma vez os estados perdidos, a partir da sequência
+        first_seq. Observadores que não precisam do histórico podem ig-
+        norar esse método.
+        '''
+        pass
 
 
 class ObserverA(AbstractObserver):
@@ -99,6 +561,345 @@ class ObserverB(AbstractObserver):
         
     def update(self, sbj: AbstractSubject) -> None:
         print(f'Reação do observador B ao estado atual: {sbj.state}')
+
+
+class AbstractAsyncObserver(AbstractObserver):
+    '''
+    Observadores assíncronos declaram a reação como uma corotina. Isso
+    é útil quando a reação espera por I/O (rede, disco, etc.), pois en-
+    quanto um observador espera os outros podem avançar.
+    '''
+    
+    @abstractmethod
+    async def update(self, sbj: AbstractSubject):
+        pass
+
+
+class AsyncObserverC(AbstractAsyncObserver):
+    '''
+    Um observador assíncrono que simula uma espera por I/O
+    '''
+    
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        
+    async def update(self, sbj: AbstractSubject) -> None:
+        await asyncio.sleep(self.delay)
+        print(f'Reação do observador C ao estado atual: {sbj.state}')
+
+
+class AsyncSubject(AbstractSubject):
+    '''
+    Versão assíncrona do sujeito. Ao invés de chamar cada observador em
+    sequência, a notificação dispara todas as reações ao mesmo tempo com
+    asyncio.gather. Observadores síncronos e assíncronos podem ser mis-
+    turados.
+    
+    O semáforo limita quantas reações ficam em andamento (max_concurre-
+    ncy), e notify só termina quando todas terminam, o que segura o su-
+    jeito quando os observadores estão lentos (backpressure). Um obser-
+    vador que passa do tempo limite (timeout) é cancelado, sem atrasar
+    os demais.
+    '''
+    
+    __observers : ObserverRegistry
+    __state : int
+    
+    def __init__(self, max_concurrency: int = 100,
+                 timeout: Optional[float] = 1.0, weak: bool = False) -> None:
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency deve ser ao menos 1')
+        self.__observers = ObserverRegistry(weak)
+        self.__state = 0
+        self.__max_concurrency = max_concurrency
+        self.__semaphore = None
+        self.__loop = None
+        self.__timeout = timeout
+        self.timeouts = 0
+        
+    def attach(self, obs: AbstractObserver, topic: Hashable = None,
+               states: Optional[range] = None) -> None:
+        self.__observers.add(obs, topic, states)
+        
+    def dettach(self, obs: AbstractObserver) -> None:
+        return self.__observers.remove(obs)
+    
+    async def __deliver(self, obs: AbstractObserver,
+                        semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            result = obs.update(self)
+            if not isawaitable(result):
+                return
+            try:
+                await asyncio.wait_for(result, self.__timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+    
+    def __get_semaphore(self) -> asyncio.Semaphore:
+        '''
+        O semáforo pertence a um event loop, então é recriado caso o su-
+        jeito passe a ser usado em outro loop
+        '''
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            self.__semaphore = asyncio.Semaphore(self.__max_concurrency)
+            self.__loop = loop
+        return self.__semaphore
+    
+    async def notify(self, topic: Hashable = None) -> None:
+        semaphore = self.__get_semaphore()
+        await asyncio.gather(*(
+            self.__deliver(obs, semaphore)
+            for obs in self.__observers.match(self.__state, topic)
+        ))
+        
+    async def task(self, topic: Hashable = None) -> None:
+        self.__state = randrange(0, 10)
+        await self.notify(topic)
+        
+    @property
+    def state(self) -> int:
+        return self.__state
+        
+        
+class _Subscriber:
+    '''
+    Um processo inscrito no SocketPublisher: a conexão, uma fila limita-
+    da de frames e uma thread que envia os frames, para que um inscrito
+    lento não trave o sujeito nem os outros inscritos
+    '''
+    
+    frames : Deque[bytes]
+    
+    def __init__(self, conn: socket, max_queued: int) -> None:
+        self.conn = conn
+        self.frames = deque()
+        self.closed = False
+        self.__max_queued = max_queued
+        self.__ready = Condition()
+        self.__thread = Thread(target=self.__send, daemon=True)
+        self.__thread.start()
+        
+    def put(self, frame: bytes) -> bool:
+        '''
+        Enfileira o frame sem esperar. Retorna False se o inscrito já foi
+        encerrado ou se a fila está cheia
+        '''
+        with self.__ready:
+            if self.closed or len(self.frames) >= self.__max_queued:
+                return False
+            self.frames.append(frame)
+            self.__ready.notify()
+            return True
+        
+    def __send(self) -> None:
+        while True:
+            with self.__ready:
+                while not self.frames and not self.closed:
+                    self.__ready.wait()
+                if not self.frames:
+                    break
+                frame = self.frames.popleft()
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                break
+        with self.__ready:
+            self.closed = True
+            self.frames.clear()
+        self.conn.close()
+        
+    def close(self, timeout: Optional[float] = None) -> None:
+        '''
+        Encerra depois de enviar o que está na fila. Com timeout, espera
+        no máximo esse tempo e depois derruba a conexão
+        '''
+        with self.__ready:
+            self.closed = True
+            self.__ready.notify()
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            self.abort()
+            
+    def abort(self) -> None:
+        with self.__ready:
+            self.closed = True
+            self.frames.clear()
+            self.__ready.notify()
+        try:
+            self.conn.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SocketPublisher(AbstractObserver):
+    '''
+    Ponte entre um sujeito e observadores que vivem em outros processos
+    da mesma máquina. O publisher é só mais um observador do sujeito:
+    a cada update ele guarda o estado em um buffer e, quando o buffer
+    enche (batch_size), envia um frame com todos os estados para cada
+    processo inscrito, por um socket Unix. Com max_delay, uma thread
+    também envia o buffer a cada max_delay segundos, então nenhum esta-
+    do espera mais que isso quando o sujeito muda devagar.
+    
+    O envio não bloqueia o sujeito: cada inscrito tem uma fila de até
+    max_queued frames e a sua própria thread de envio. Um inscrito que
+    não acompanha e deixa a fila encher é desconectado.
+    
+    O frame é binário e compacto: um cabeçalho com a quantidade de es-
+    tados, seguido dos estados como inteiros de 8 bytes (array 'q'). O
+    método flush envia o que estiver no buffer sem esperar encher.
+    '''
+    
+    HEADER = Struct('!I')
+    
+    __clients : List[_Subscriber]
+    __buffer : array
+    
+    def __init__(self, path: str, batch_size: int = 64,
+                 max_delay: Optional[float] = 0.05,
+                 max_queued: int = 1024) -> None:
+        self.__path = path
+        self.__batch_size = batch_size
+        self.__max_delay = max_delay
+        self.__max_queued = max_queued
+        self.__buffer = array('q')
+        self.__buffer_lock = Lock()
+        self.__flush_lock = Lock()
+        self.__clients = []
+        self.__lock = Lock()
+        self.__closed = Event()
+        self.dropped = 0
+        self.__server = socket(AF_UNIX, SOCK_STREAM)
+        self.__server.bind(path)
+        self.__server.listen()
+        Thread(target=self.__accept, daemon=True).start()
+        if max_delay is not None:
+            Thread(target=self.__flush_periodically, daemon=True).start()
+        
+    @property
+    def subscribers(self) -> int:
+        with self.__lock:
+            return len(self.__clients)
+        
+    def __accept(self) -> None:
+        while True:
+            try:
+                conn, _ = self.__server.accept()
+            except OSError:
+                return
+            with self.__lock:
+                self.__clients.append(_Subscriber(conn, self.__max_queued))
+                
+    def __flush_periodically(self) -> None:
+        while not self.__closed.wait(self.__max_delay):
+            self.flush()
+        
+    def update(self, sbj: AbstractSubject) -> None:
+        with self.__buffer_lock:
+            self.__buffer.append(sbj.state)
+            full = len(self.__buffer) >= self.__batch_size
+        if full:
+            self.flush()
+            
+    def flush(self) -> None:
+        '''
+        Flushes são serializados, da troca do buffer até o frame entrar
+        na fila de todos os inscritos, para que os frames do update e da
+        thread periódica não cheguem fora de ordem
+        '''
+        with self.__flush_lock:
+            with self.__buffer_lock:
+                if not self.__buffer:
+                    return
+                buffer, self.__buffer = self.__buffer, array('q')
+            frame = self.HEADER.pack(len(buffer)) + buffer.tobytes()
+            with self.__lock:
+                for client in list(self.__clients):
+                    if not client.put(frame):
+                        self.__clients.remove(client)
+                        self.dropped += 1
+                        client.abort()
+                    
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        '''
+        Envia o que falta e encerra as conexões, o que sinaliza o fim da
+        transmissão para os processos inscritos
+        '''
+        self.__closed.set()
+        self.flush()
+        try:
+            self.__server.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.__server.close()
+        os.unlink(self.__path)
+        with self.__lock:
+            clients, self.__clients = self.__clients, []
+        for client in clients:
+            client.close(timeout)
+
+
+class RemoteSubject(AbstractSubject):
+    '''
+    O lado do processo trabalhador: um sujeito local que espelha o su-
+    jeito remoto. Ele lê os frames do SocketPublisher e notifica os ob-
+    servadores locais a cada estado recebido, então os observadores não
+    sabem que o sujeito real está em outro processo (padrão Proxy).
+    '''
+    
+    __observers : ObserverRegistry
+    __state : int
+    
+    def __init__(self, path: str, weak: bool = False) -> None:
+        self.__observers = ObserverRegistry(weak)
+        self.__state = 0
+        self.__conn = socket(AF_UNIX, SOCK_STREAM)
+        self.__conn.connect(path)
+        self.__reader = self.__conn.makefile('rb')
+        
+    def attach(self, obs: AbstractObserver, topic: Hashable = None,
+               states: Optional[range] = None) -> None:
+        self.__observers.add(obs, topic, states)
+        
+    def dettach(self, obs: AbstractObserver) -> None:
+        return self.__observers.remove(obs)
+    
+    def notify(self, topic: Hashable = None) -> None:
+        for obs in self.__observers.match(self.__state, topic):
+            obs.update(self)
+            
+    def receive(self) -> bool:
+        '''
+        Lê e entrega um frame. Retorna False quando o publisher fecha a
+        conexão, inclusive no meio de um frame (frame truncado)
+        '''
+        header = self.__reader.read(SocketPublisher.HEADER.size)
+        if len(header) < SocketPublisher.HEADER.size:
+            return False
+        (count,) = SocketPublisher.HEADER.unpack(header)
+        states = array('q')
+        payload = self.__reader.read(count * states.itemsize)
+        if len(payload) < count * states.itemsize:
+            return False
+        states.frombytes(payload)
+        for state in states:
+            self.__state = state
+            self.notify()
+        return True
+    
+    def serve_forever(self) -> None:
+        while self.receive():
+            pass
+        self.close()
+        
+    def close(self) -> None:
+        self.__reader.close()
+        self.__conn.close()
+        
+    @property
+    def state(self) -> int:
+        return self.__state
         
         
 # Testes
@@ -112,10 +913,327 @@ def observer_tests() -> bool:
     sbj.dettach(obs_b)
     sbj.task()
     return True
+
+class CountingObserver(AbstractObserver):
+    '''
+    Observador silencioso, usado nos testes, que só conta as reações
+    '''
+    
+    def __init__(self) -> None:
+        self.count = 0
+        
+    def update(self, sbj: AbstractSubject) -> None:
+        self.count += 1
+
+def registry_tests() -> bool:
+    sbj = Subject()
+    every, news, low = CountingObserver(), CountingObserver(), \
+        CountingObserver()
+    sbj.attach(every)
+    sbj.attach(news, topic='news')
+    sbj.attach(low, states=range(0, 5))
+    for _ in range(20):
+        sbj.task()
+    assert(every.count == 20 and news.count == 0)
+    assert(low.count < 20)
+    sbj.task(topic='news')
+    assert(news.count == 1 and every.count == 21)
+    sbj.dettach(news)
+    sbj.task(topic='news')
+    assert(news.count == 1)
+    registry = ObserverRegistry()
+    observers = [CountingObserver() for _ in range(5)]
+    for i, obs in enumerate(observers):
+        registry.add(obs, topic='t' if i % 2 else None)
+    assert(registry.match(0, topic='t') == observers)
+    wide, narrow = CountingObserver(), CountingObserver()
+    registry.add(wide, states=range(0, 10**6, 2))
+    registry.add(narrow, topic='t', states=range(3, 5))
+    registry.add(observers[0], states=range(4, 6))
+    assert(registry.match(4, topic='t') == observers[1:] + [wide, narrow,
+                                                            observers[0]])
+    assert(registry.match(3) == [observers[2], observers[4]])
+    registry.remove(narrow)
+    registry.remove(wide)
+    assert(registry.match(4, topic='t') == observers[1:] + [observers[0]])
+    assert(registry.match(6, topic='u') == [observers[2], observers[4]])
+    return True
+
+class BatchObserver(AbstractObserver):
+    '''
+    Observador que consome o lote de mudanças de um CoalescingSubject
+    '''
+    
+    def __init__(self) -> None:
+        self.seen : List[int] = []
+        self.states : List[int] = []
+        
+    def update(self, sbj: StateSnapshot) -> None:
+        assert(sbj.changes[-1] == sbj.state)
+        self.seen.extend(sbj.changes)
+        self.states.append(sbj.state)
+
+def coalescing_tests() -> bool:
+    sbj = CoalescingSubject(window=60.0, max_batch=10)
+    counter, batch = CountingObserver(), BatchObserver()
+    sbj.attach(counter)
+    sbj.attach(batch)
+    for _ in range(25):
+        sbj.task()
+    assert(counter.count == 2)
+    sbj.flush()
+    assert(counter.count == 3 and len(batch.seen) == 25)
+    assert(sbj.delivered == 3 and sbj.saved == 22)
+    sbj.flush()
+    assert(counter.count == 3)
+    sbj = CoalescingSubject(window=60.0)
+    low, news = BatchObserver(), BatchObserver()
+    sbj.attach(low, states=range(0, 5))
+    sbj.attach(news, topic='news')
+    for _ in range(50):
+        for _ in range(4):
+            sbj.task(topic=choice([None, 'news']))
+        sbj.flush()
+    assert(all(state < 5 for state in low.states))
+    assert(news.states)
+    sbj = CoalescingSubject(window=0.01, autoflush=True)
+    sbj.attach(counter)
+    sbj.task()
+    sleep(0.1)
+    assert(counter.count == 4 and sbj.delivered == 1)
+    return True
+
+def weak_registry_tests() -> bool:
+    registry = ObserverRegistry(weak=True)
+    keep = CountingObserver()
+    registry.add(keep)
+    for _ in range(100):
+        registry.add(CountingObserver(), topic='t')
+    assert(len(registry) == 1)
+    assert(registry.match(0, topic='t') == [keep])
+    sbj = Subject(weak=True)
+    sbj.attach(keep)
+    sbj.attach(CountingObserver())
+    sbj.task()
+    assert(keep.count == 1)
+    return True
+
+def weak_registry_benchmark(n: int = 1_000_000,
+                            rounds: int = 3) -> Dict[str, List[tuple]]:
+    '''
+    Benchmark (executar manualmente, leva alguns minutos): a cada roda-
+    da, n observadores são inscritos e esquecidos sem dettach. Para os
+    modos forte e fraco, mede a memória alocada (MB, via tracemalloc)
+    e a latência de um notify (s) ao fim de cada rodada.
+    '''
+    results = {}
+    for weak in (False, True):
+        tracemalloc.start()
+        sbj = Subject(weak=weak)
+        keep = CountingObserver()
+        sbj.attach(keep)
+        samples = []
+        for _ in range(rounds):
+            for _ in range(n):
+                sbj.attach(CountingObserver())
+            start = perf_counter()
+            sbj.notify()
+            elapsed = perf_counter() - start
+            current, _ = tracemalloc.get_traced_memory()
+            samples.append((current / 2**20, elapsed))
+        del sbj
+        tracemalloc.stop()
+        mode = 'weak' if weak else 'strong'
+        results[mode] = samples
+        for i, (mb, seconds) in enumerate(samples):
+            print(f'{mode:>6} rodada {i}: {mb:8.1f} MB, notify {seconds:.4f} s')
+    return results
+
+class RecordingObserver(AbstractObserver):
+    '''
+    Observador lento que registra a sequência de estados que recebeu
+    '''
+    
+    def __init__(self) -> None:
+        self.seen : List[int] = []
+        
+    def update(self, sbj: AbstractSubject) -> None:
+        sum(range(1000))
+        self.seen.append(sbj.state)
+
+def dispatcher_tests() -> bool:
+    dispatcher = ThreadPoolDispatcher(max_workers=4)
+    sbj = Subject(dispatcher=dispatcher)
+    observers = [RecordingObserver() for _ in range(8)]
+    for obs in observers:
+        sbj.attach(obs)
+    states = []
+    for _ in range(200):
+        sbj.task()
+        states.append(sbj.state)
+    dispatcher.shutdown()
+    assert(not dispatcher.errors)
+    assert(all(obs.seen == states for obs in observers))
+    dispatcher = ProcessPoolDispatcher(max_workers=2)
+    sbj = Subject(dispatcher=dispatcher)
+    sbj.attach(CountingObserver())
+    sbj.attach(RecordingObserver())
+    for _ in range(10):
+        sbj.task()
+    dispatcher.shutdown()
+    assert(not dispatcher.errors)
+    return True
+
+class ReplayObserver(RecordingObserver):
+    '''
+    Observador que reconstrói a sequência completa a partir do histórico
+    '''
+    
+    def catch_up(self, sbj: AbstractSubject, first_seq: int,
+                 states: array) -> None:
+        self.first_seq = first_seq
+        self.seen.extend(states)
+
+def history_tests() -> bool:
+    history = StateHistory(capacity=4)
+    assert(history.since(1) == (1, array('q')))
+    for state in range(6):
+        history.append(state)
+    assert(len(history) == 4 and history.last_seq == 6)
+    assert(history.since(1) == (3, array('q', [2, 3, 4, 5])))
+    assert(history.since(5) == (5, array('q', [4, 5])))
+    sbj = Subject(history=100)
+    states = []
+    for _ in range(30):
+        sbj.task()
+        states.append(sbj.state)
+    assert(sbj.seq == 30)
+    late = ReplayObserver()
+    sbj.attach(late, since=11)
+    sbj.task()
+    states.append(sbj.state)
+    assert(late.first_seq == 11 and late.seen == states[10:])
+    return True
+
+def _remote_worker(path: str, results: Queue) -> None:
+    sbj = RemoteSubject(path)
+    obs = RecordingObserver()
+    sbj.attach(obs)
+    sbj.serve_forever()
+    results.put(obs.seen)
+
+def transport_tests() -> bool:
+    path = os.path.join(mkdtemp(), 'subject.sock')
+    publisher = SocketPublisher(path, batch_size=16)
+    sbj = Subject()
+    sbj.attach(publisher)
+    results = Queue()
+    workers = [
+        Process(target=_remote_worker, args=(path, results))
+        for _ in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    deadline = monotonic() + 5.0
+    while publisher.subscribers < len(workers) and monotonic() < deadline:
+        sleep(0.01)
+    states = []
+    for _ in range(100):
+        sbj.task()
+        states.append(sbj.state)
+    publisher.close()
+    received = [results.get(timeout=5.0) for _ in workers]
+    for worker in workers:
+        worker.join()
+    os.rmdir(os.path.dirname(path))
+    assert(all(seen == states for seen in received))
+    path = os.path.join(mkdtemp(), 'subject.sock')
+    publisher = SocketPublisher(path, batch_size=1000, max_delay=0.01,
+                                max_queued=16)
+    slow, fast = socket(AF_UNIX, SOCK_STREAM), socket(AF_UNIX, SOCK_STREAM)
+    slow.connect(path)
+    fast.connect(path)
+    received = []
+    
+    def drain() -> None:
+        while chunk := fast.recv(1 << 16):
+            received.append(chunk)
+    
+    while publisher.subscribers < 2:
+        sleep(0.01)
+    sbj = Subject()
+    sbj.attach(publisher)
+    sbj.task()
+    first = fast.recv(SocketPublisher.HEADER.size + 8)
+    assert(SocketPublisher.HEADER.unpack(first[:4]) == (1,))
+    reader = Thread(target=drain)
+    reader.start()
+    start = monotonic()
+    while not publisher.dropped and monotonic() - start < 5.0:
+        for _ in range(1000):
+            sbj.task()
+    assert(publisher.dropped == 1 and publisher.subscribers == 1)
+    publisher.close()
+    reader.join()
+    slow.close()
+    fast.close()
+    server = socket(AF_UNIX, SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    remote = RemoteSubject(path)
+    conn, _ = server.accept()
+    conn.sendall(SocketPublisher.HEADER.pack(4) + bytes(10))
+    conn.close()
+    server.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+    assert(not remote.receive())
+    remote.close()
+    path = os.path.join(mkdtemp(), 'subject.sock')
+    publisher = SocketPublisher(path, batch_size=7, max_delay=0.0001,
+                                max_queued=50_000)
+    remote = RemoteSubject(path)
+    obs = RecordingObserver()
+    remote.attach(obs)
+    reader = Thread(target=remote.serve_forever)
+    reader.start()
+    while publisher.subscribers < 1:
+        sleep(0.01)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    for state in range(50_000):
+        publisher.update(StateSnapshot(state))
+    sys.setswitchinterval(interval)
+    publisher.close(timeout=None)
+    reader.join()
+    os.rmdir(os.path.dirname(path))
+    assert(obs.seen == list(range(50_000)))
+    return True
+
+def async_observer_tests() -> bool:
+    sbj = AsyncSubject(max_concurrency=2, timeout=0.05)
+    sbj.attach(ObserverA())
+    sbj.attach(AsyncObserverC(delay=0.01))
+    sbj.attach(AsyncObserverC(delay=0.01))
+    slow = AsyncObserverC(delay=1.0)
+    sbj.attach(slow)
+    asyncio.run(sbj.task())
+    assert(sbj.timeouts == 1)
+    sbj.dettach(slow)
+    asyncio.run(sbj.task())
+    assert(sbj.timeouts == 1)
+    return True
     
 # Main
 def main() -> None:
     assert(observer_tests())
+    assert(registry_tests())
+    assert(coalescing_tests())
+    assert(weak_registry_tests())
+    assert(dispatcher_tests())
+    assert(transport_tests())
+    assert(history_tests())
+    assert(async_observer_tests())
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
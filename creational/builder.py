@@ -6,8 +6,18 @@ Data: 21/02/2025
 """
 
 from __future__ import annotations
+import io
+import os
+import sys
+import tracemalloc
 from abc import ABC, abstractmethod
-from typing import TypeVar, List
+from array import array
+from inspect import getgeneratorstate, isgenerator, GEN_CREATED
+from itertools import islice
+from socket import socketpair
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, TypeVar, List, Optional, Tuple
 
 
 class AbstractBuilder(ABC):
@@ -47,12 +57,14 @@ class Builder1(AbstractBuilder):
     
     def __init__(self) -> None:
         '''
-        Cada instância de um builder deve começar um produto do zero
+        Cada instância de um builder deve começar um produto do zero.
+        Os produtos de um mesmo builder dividem a tabela de partes
         '''
+        self._table = PartTable()
         self.reset()
         
     def reset(self) -> None:
-        self._product = Product1()
+        self._product = Product1(self._table)
         
     @property
     def product(self) -> Product1:
@@ -68,36 +80,200 @@ class Builder1(AbstractBuilder):
     
     def produce_part_c(self) -> None:
         self._product.add("part_c")
+
+
+def sink_writer(sink: Any) -> Callable[[str], None]:
+    '''
+    Adapta um destino de texto para uma função de escrita: geradores
+    (send), sockets (sendall, em UTF-8), arquivos (write) ou qualquer
+    callable
+    '''
+    if isgenerator(sink):
+        if getgeneratorstate(sink) == GEN_CREATED:
+            next(sink)
+        return sink.send
+    if hasattr(sink, 'sendall'):
+        return lambda text: sink.sendall(text.encode())
+    if hasattr(sink, 'write'):
+        return sink.write
+    if callable(sink):
+        return sink
+    raise TypeError(f'Destino não suportado: {type(sink).__name__}')
+
+
+class StreamingBuilder1(AbstractBuilder):
+    '''
+    Um builder que não materializa o produto: cada parte é escrita no
+    destino (sink) assim que é produzida, separada por separator, e ca-
+    da produto exportado termina com end. A memória usada não depende
+    do tamanho do produto; o produto exportado é só um resumo.
+    '''
+    
+    def __init__(self, sink: Any, separator: str = ', ',
+                 end: str = '\n') -> None:
+        self._write = sink_writer(sink)
+        self._separator = separator
+        self._end = end
+        self.reset()
+        
+    def reset(self) -> None:
+        self._count = 0
+        
+    @property
+    def product(self) -> StreamedProduct1:
+        product = StreamedProduct1(self._count)
+        self._write(self._end)
+        self.reset()
+        return product
+    
+    def _emit(self, part: str) -> None:
+        self._write(f'{self._separator}{part}' if self._count else part)
+        self._count += 1
+    
+    def produce_part_a(self) -> None:
+        self._emit("part_a")
+    
+    def produce_part_b(self) -> None:
+        self._emit("part_b")
+    
+    def produce_part_c(self) -> None:
+        self._emit("part_c")
+
+
+class StreamedProduct1:
+    '''
+    O que resta de um produto que foi transmitido: só a contagem de par-
+    tes, já que as partes estão no destino
+    '''
+    
+    def __init__(self, count: int) -> None:
+        self.count = count
        
 
+class PartTable:
+    '''
+    Tabela de interning das partes: cada nome de parte diferente recebe
+    um id uma única vez. Ela pertence a um builder (ou a um produto
+    avulso), então só cresce com as partes que ele produz, e pode ser
+    usada por várias threads
+    '''
+    
+    _ids: Dict[Any, int]
+    _names: List[Any]
+    
+    def __init__(self) -> None:
+        self._ids = {}
+        self._names = []
+        self._lock = Lock()
+        
+    def __len__(self) -> int:
+        return len(self._names)
+        
+    @property
+    def names(self) -> List[Any]:
+        return self._names
+        
+    def intern(self, part: Any) -> int:
+        part_id = self._ids.get(part)
+        if part_id is None:
+            with self._lock:
+                part_id = self._ids.get(part)
+                if part_id is None:
+                    part_id = len(self._names)
+                    self._names.append(part)
+                    self._ids[part] = part_id
+        return part_id
+
+
 class Product1():
     '''
     Produtos no padrão Builder são geralmente extensos e complexos, com
     diversas etapas e partes. Além disso, diferentes builders constroem
     diferentes e não relacionados produtos (sem interface comum)
+    
+    Aqui, as partes são guardadas de forma compacta: cada nome de parte
+    diferente recebe um id na tabela de partes, e o produto guarda só um
+    array de ids. O array começa com 2 bytes por id e passa a 4 quando a
+    tabela passa de 65.536 partes.
     '''
     
     Part = TypeVar("Part")
-    _parts: List[Part]
+    _parts: array
+    _table: PartTable
     
-    def __init__(self) -> None:
-        self._parts = []
+    def __init__(self, table: Optional[PartTable] = None) -> None:
+        self._parts = array('H')
+        self._table = PartTable() if table is None else table
         
     def add(self, part: Part) -> None:
-        self._parts.append(part)
+        part_id = self._table.intern(part)
+        try:
+            self._parts.append(part_id)
+        except OverflowError:
+            self._parts = array('I', self._parts)
+            self._parts.append(part_id)
+        
+    def replicate(self, n: int) -> List[Product1]:
+        '''
+        n cópias do produto, cada uma com a sua cópia do array de ids
+        '''
+        cls, parts, table = type(self), self._parts, self._table
+        copies = []
+        for _ in range(n):
+            product = cls.__new__(cls)
+            product._parts = parts[:]
+            product._table = table
+            copies.append(product)
+        return copies
+        
+    @property
+    def parts(self) -> List[Part]:
+        names = self._table.names
+        return [names[i] for i in self._parts]
         
-    def list_parts(self) -> None:
-        print(f'Partes do produto: {', '.join(self._parts)}')
+    def iter_parts(self, chunk_size: int = 4096) -> Iterator[str]:
+        '''
+        Texto da lista de partes em pedaços de até chunk_size partes, sem
+        montar a string inteira
+        '''
+        names = self._table.names
+        ids = iter(self._parts)
+        separator = ''
+        while chunk := list(islice(ids, chunk_size)):
+            yield separator + ', '.join([names[i] for i in chunk])
+            separator = ', '
+        
+    def list_parts(self, file: Optional[Any] = None,
+                   chunk_size: int = 4096) -> None:
+        write = sink_writer(sys.stdout if file is None else file)
+        write('Partes do produto: ')
+        for chunk in self.iter_parts(chunk_size):
+            write(chunk)
+        write('\n')
         
 class Director:
     '''
     (opcional, mas util)
     O diretor é um objeto responsável por dirigir o builder e realizar
     construções que seguem um padrão, sequência ou diretriz
+    
+    As receitas (RECIPES) dizem quais partes cada tipo de produto tem. A
+    primeira construção de um tipo compila a receita em um plano: uma
+    tupla com os métodos do builder já resolvidos, sem comparações de
+    strings nas construções seguintes. Tipos desconhecidos usam a recei-
+    ta 'large'.
     '''
     
+    RECIPES: Dict[str, Tuple[str, ...]] = {
+        'small': ('produce_part_a',),
+        'large': ('produce_part_a', 'produce_part_b', 'produce_part_c'),
+    }
+    
+    _plans: Dict[str, Tuple[Callable[[], None], ...]]
+    
     def __init__(self) -> None:
         self._builder = None
+        self._plans = {}
         
     @property
     def builder(self) -> AbstractBuilder:
@@ -111,14 +287,44 @@ class Director:
         '''
         
         self._builder = builder
+        self._plans = {}
+        
+    def compile(self, kind: str) -> Tuple[Callable[[], None], ...]:
+        plan = self._plans.get(kind)
+        if plan is None:
+            recipe = self.RECIPES.get(kind, self.RECIPES['large'])
+            plan = tuple(getattr(self._builder, step) for step in recipe)
+            self._plans[kind] = plan
+        return plan
         
     def build(self, kind:str = 'small') -> None:
-        if kind == 'small':
-            self.builder.produce_part_a()
-        else:
-            self.builder.produce_part_a()
-            self.builder.produce_part_b()
-            self.builder.produce_part_c()
+        for step in self.compile(kind):
+            step()
+            
+    def build_many(self, kind: str, n: int) -> List[Product1]:
+        '''
+        Constrói n produtos de uma vez. Como o plano de um tipo é fixo, o
+        resultado é sempre o mesmo: o plano roda uma vez e o produto é
+        replicado, se ele souber se replicar. Caso contrário, o plano
+        roda n vezes em um único laço.
+        '''
+        if n < 1:
+            return []
+        plan = self.compile(kind)
+        builder = self._builder
+        for step in plan:
+            step()
+        first = builder.product
+        replicate = getattr(first, 'replicate', None)
+        if replicate is not None:
+            return [first, *replicate(n - 1)]
+        products = [first]
+        append = products.append
+        for _ in range(n - 1):
+            for step in plan:
+                step()
+            append(builder.product)
+        return products
         
 # Teste
 def builder_test() -> bool:
@@ -137,8 +343,112 @@ def builder_test() -> bool:
     # Deu tudo certo!
     return True
 
+def build_many_test() -> bool:
+    director = Director()
+    director.builder = Builder1()
+    products = director.build_many('large', 100)
+    assert(len({id(p) for p in products}) == 100)
+    assert(all(p.parts == ['part_a', 'part_b', 'part_c'] for p in products))
+    assert(director.build_many('small', 1)[0].parts == ['part_a'])
+    assert(products[0]._parts.itemsize == 2)
+    products[0].add('part_d')
+    assert(products[1].parts == ['part_a', 'part_b', 'part_c'])
+    assert(director.build_many('large', 0) == [])
+    product = Product1()
+    for part in range(70_000):
+        product.add(part)
+    assert(product.parts == list(range(70_000)))
+    assert(product._parts.itemsize == 4)
+    fresh = Product1()
+    fresh.add('brand-new')
+    assert(fresh.parts == ['brand-new'] and fresh._parts.itemsize == 2)
+    assert(len(director.builder._table) == 4)
+    return True
+
+def streaming_builder_test() -> bool:
+    director = Director()
+    out = io.StringIO()
+    director.builder = StreamingBuilder1(out)
+    director.build(kind='large')
+    director.build(kind='small')
+    director.build(kind='large')
+    assert(director.builder.product.count == 7)
+    assert(out.getvalue() == 'part_a, part_b, part_c, part_a, part_a, '
+                             'part_b, part_c\n')
+    received = []
+    
+    def collector():
+        while True:
+            received.append((yield))
+    
+    director.builder = StreamingBuilder1(collector(), separator='|')
+    director.build(kind='large')
+    director.builder.product
+    assert(''.join(received) == 'part_a|part_b|part_c\n')
+    left, right = socketpair()
+    director.builder = StreamingBuilder1(left)
+    director.build(kind='small')
+    director.builder.product
+    left.close()
+    assert(right.recv(64) == b'part_a\n')
+    right.close()
+    builder = Builder1()
+    for _ in range(10_000):
+        builder.produce_part_b()
+    product = builder.product
+    out = io.StringIO()
+    product.list_parts(file=out, chunk_size=333)
+    assert(out.getvalue() ==
+           f"Partes do produto: {', '.join(product.parts)}\n")
+    return True
+
+def streaming_memory_benchmark(sizes: Tuple[int, ...] = (10**4, 10**5, 10**6)
+                               ) -> Dict[int, int]:
+    '''
+    Benchmark (executar manualmente): pico de memória (bytes, via trace-
+    malloc) ao transmitir produtos de tamanhos crescentes para um arqui-
+    vo nulo. O pico deve ficar constante.
+    '''
+    results = {}
+    with open(os.devnull, 'w') as null:
+        for size in sizes:
+            builder = StreamingBuilder1(null)
+            tracemalloc.start()
+            for _ in range(size):
+                builder.produce_part_a()
+            builder.product
+            results[size] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{size:>9} partes: pico de {results[size]:,} bytes')
+    return results
+
+def builder_benchmark(n: int = 1_000_000) -> Dict[str, float]:
+    '''
+    Benchmark (executar manualmente): produtos grandes por segundo, com
+    build seguido de product em laço e com build_many
+    '''
+    director = Director()
+    builder = Builder1()
+    director.builder = builder
+    
+    def one_by_one() -> None:
+        for _ in range(n):
+            director.build(kind='large')
+            builder.product
+            
+    results = {}
+    for name, run in (('build', one_by_one),
+                      ('build_many', lambda: director.build_many('large', n))):
+        start = perf_counter()
+        run()
+        results[name] = n / (perf_counter() - start)
+        print(f'{name:>10}: {results[name]:,.0f} produtos/s')
+    return results
+
 def main() -> None:
     assert(builder_test())
+    assert(build_many_test())
+    assert(streaming_builder_test())
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,9 +5,18 @@ Autor: Sergio P.
 Data: 18/11/2024
 """
 
+import gc
+import json
+import os
 from abc import ABC, abstractmethod
-from typing import Dict
+from importlib import import_module
+from importlib.metadata import EntryPoint, entry_points
+from tempfile import mkstemp
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Union
 from typing_extensions import Self
+from weakref import WeakKeyDictionary
 
 class AbstractProduct(ABC):
     '''
@@ -24,12 +33,42 @@ class AbstractProduct(ABC):
     
     def copy(self) -> Self:
         '''
-        Método do Projeto Padrão Prototype
+        Método do Projeto Padrão Prototype. A classe vem direto de type,
+        sem eval, o que também funciona com subclasses de outros módulos
         '''
-        object = eval(type(self).__name__)
-        newInstance = object.__new__(object)
+        cls = type(self)
+        newInstance = cls.__new__(cls)
         newInstance.__dict__ = self.__dict__.copy()
         return newInstance
+    
+    def copy_many(self, n: int) -> List[Self]:
+        '''
+        Cria n cópias de uma vez
+        '''
+        cls, state = type(self), self.__dict__
+        new = cls.__new__
+        copies = [new(cls) for _ in range(n)]
+        for newInstance in copies:
+            newInstance.__dict__ = state.copy()
+        return copies
+    
+    def release(self) -> bool:
+        '''
+        Devolve o produto ao pool do criador que o entregou, se houver
+        um. Depois disso, o produto não deve mais ser usado
+        '''
+        owner = _pool_owners.pop(self, None)
+        if owner is None:
+            return False
+        creator, key = owner
+        creator._release(self, key)
+        return True
+
+
+# Quem entregou cada produto de um pool. Fica fora do produto para que
+# cópias não herdem o dono e o estado do produto não mude
+_pool_owners : 'WeakKeyDictionary[AbstractProduct, tuple]' = \
+    WeakKeyDictionary()
 
 
 class ProductA(AbstractProduct):
@@ -52,6 +91,82 @@ class ProductB(AbstractProduct):
         return 'bar'
 
 
+class PrototypeRegistry:
+    '''
+    Registro preguiçoso de protótipos. Cada chave é registrada com uma
+    fábrica: um callable ou o caminho "modulo:Classe". Nada é importado
+    nem construído no registro; o protótipo só é criado (e o módulo só
+    é importado) no primeiro uso da chave, e então fica guardado.
+    
+    Além do registro direto, as fábricas podem ser descobertas por en-
+    try points de pacotes instalados (discover) ou lidas de um manifes-
+    to JSON com {chave: "modulo:Classe"} (load_manifest).
+    '''
+    
+    ENTRY_POINT_GROUP = 'design_patterns.products'
+    
+    _factories : Dict[str, Union[Callable[[], AbstractProduct], str]]
+    _prototypes : Dict[str, AbstractProduct]
+    
+    def __init__(self) -> None:
+        self._factories = {}
+        self._prototypes = {}
+        self._lock = Lock()
+        
+    def __contains__(self, key: str) -> bool:
+        return key in self._factories
+    
+    def keys(self) -> List[str]:
+        return list(self._factories)
+        
+    def register(self, key: str,
+                 factory: Union[Callable[[], AbstractProduct], str]) -> None:
+        with self._lock:
+            self._factories[key] = factory
+            self._prototypes.pop(key, None)
+            
+    def discover(self, group: str = ENTRY_POINT_GROUP) -> int:
+        '''
+        Registra as fábricas dos entry points do grupo. O entry point só
+        é carregado (EntryPoint.load) no primeiro uso da chave
+        '''
+        found = entry_points(group=group)
+        for ep in found:
+            self.register(ep.name, _entry_point_factory(ep))
+        return len(found)
+    
+    def load_manifest(self, path: str) -> int:
+        with open(path) as file:
+            manifest = json.load(file)
+        for key, target in manifest.items():
+            self.register(key, target)
+        return len(manifest)
+    
+    def get(self, key: str) -> AbstractProduct:
+        prototype = self._prototypes.get(key)
+        if prototype is not None:
+            return prototype
+        with self._lock:
+            if key not in self._prototypes:
+                factory = self._factories[key]
+                if isinstance(factory, str):
+                    module, _, name = factory.partition(':')
+                    factory = import_module(module)
+                    for attr in name.split('.'):
+                        factory = getattr(factory, attr)
+                self._prototypes[key] = factory()
+            return self._prototypes[key]
+
+
+def _entry_point_factory(ep: EntryPoint) -> Callable[[], AbstractProduct]:
+    return lambda: ep.load()()
+
+
+default_registry = PrototypeRegistry()
+default_registry.register('A', ProductA)
+default_registry.register('B', ProductB)
+
+
 class AbstractCreator(ABC):
     '''
     A entidade criadora de produtos define uma interface com um método
@@ -70,16 +185,79 @@ class Creator(AbstractCreator):
     por instanciar os produtos corretos. Aqui, eu usei o padrão protóti-
     po para instanciar os produtos partir de uma tabela hash... mas não
     é necessário
+    
+    Os protótipos vêm de um registro preguiçoso, então criar um Creator
+    não constrói nenhum produto: cada protótipo é criado no primeiro
+    pedido da sua chave.
     '''
     
-    __prototypes : Dict[str, AbstractProduct] = {}
+    __prototypes : PrototypeRegistry
     
-    def __init__(self) -> None:
-        self.__prototypes['A'] = ProductA()
-        self.__prototypes['B'] = ProductB()
+    def __init__(self, registry: Optional[PrototypeRegistry] = None) -> None:
+        self.__prototypes = registry or default_registry
 
     def factoryMethod(self, product:str) -> AbstractProduct:
-        return self.__prototypes[product].copy()
+        return self.__prototypes.get(product).copy()
+    
+    def _prototype(self, product: str) -> AbstractProduct:
+        return self.__prototypes.get(product)
+
+
+class PooledCreator(Creator):
+    '''
+    Um criador que recicla produtos. Quem termina de usar um produto
+    chama release, e ele volta para o pool da sua chave, restaurado ao
+    estado do protótipo. O próximo factoryMethod da mesma chave reusa o
+    produto ao invés de alocar uma nova cópia, o que reduz o trabalho do
+    coletor de lixo. Cada chave guarda no máximo pool_size produtos li-
+    vres (ou o valor definido em pool_sizes); o excedente é descartado.
+    '''
+    
+    _free : Dict[str, List[AbstractProduct]]
+    
+    def __init__(self, pool_size: int = 64,
+                 pool_sizes: Optional[Dict[str, int]] = None,
+                 registry: Optional[PrototypeRegistry] = None) -> None:
+        super().__init__(registry)
+        self._pool_size = pool_size
+        self._pool_sizes = pool_sizes or {}
+        self._free = {}
+        self.allocations = 0
+        self.reuses = 0
+        self.releases = 0
+        self.discarded = 0
+        
+    def factoryMethod(self, product: str) -> AbstractProduct:
+        free = self._free.get(product)
+        if free:
+            instance = free.pop()
+            self.reuses += 1
+        else:
+            instance = super().factoryMethod(product)
+            self.allocations += 1
+        _pool_owners[instance] = (self, product)
+        return instance
+    
+    def _release(self, instance: AbstractProduct, product: str) -> None:
+        self.releases += 1
+        free = self._free.setdefault(product, [])
+        if len(free) >= self._pool_sizes.get(product, self._pool_size):
+            self.discarded += 1
+            return
+        state = instance.__dict__
+        state.clear()
+        state.update(self._prototype(product).__dict__)
+        free.append(instance)
+        
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'allocations': self.allocations,
+            'reuses': self.reuses,
+            'releases': self.releases,
+            'discarded': self.discarded,
+            'free': sum(map(len, self._free.values())),
+        }
 
     
 # Teste
@@ -90,11 +268,121 @@ def factory_method_tests() -> bool:
     pb1 = c.factoryMethod(product='B')
     assert id(pa1) != id(pa2)
     assert type(pa1) != type(pb1)
+    copies = pb1.copy_many(10)
+    assert len({id(p) for p in copies}) == 10
+    assert all(type(p) == ProductB for p in copies)
+    return True
+
+def pooled_creator_tests() -> bool:
+    c = PooledCreator(pool_size=2, pool_sizes={'B': 0})
+    pa1 = c.factoryMethod(product='A')
+    pa1.color = 'azul'
+    assert pa1.release() and not pa1.release()
+    pa2 = c.factoryMethod(product='A')
+    assert pa2 is pa1 and not hasattr(pa2, 'color')
+    assert vars(pa2) == vars(c._prototype('A'))
+    assert not pa2.copy().release() and not pa2.copy_many(1)[0].release()
+    pb = c.factoryMethod(product='B')
+    pb.release()
+    assert not Creator().factoryMethod(product='A').release()
+    assert c.stats == {'allocations': 2, 'reuses': 1, 'releases': 2,
+                       'discarded': 1, 'free': 0}
     return True
+
+def registry_tests() -> bool:
+    built = []
+    
+    def factory() -> AbstractProduct:
+        built.append(1)
+        return ProductA()
+    
+    registry = PrototypeRegistry()
+    registry.register('lazy', factory)
+    c = Creator(registry=registry)
+    assert not built
+    c.factoryMethod(product='lazy')
+    c.factoryMethod(product='lazy')
+    assert len(built) == 1
+    fd, path = mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as file:
+        json.dump({'frac': 'fractions:Fraction'}, file)
+    assert registry.load_manifest(path) == 1
+    os.remove(path)
+    assert registry.get('frac') == 0 and 'frac' in registry
+    assert registry.discover(group='design_patterns.nenhum') == 0
+    ep = EntryPoint(name='nested', value='datetime:datetime.now [extra]',
+                    group=PrototypeRegistry.ENTRY_POINT_GROUP)
+    registry.register(ep.name, _entry_point_factory(ep))
+    registry.register('nested_str', 'datetime:datetime.today')
+    assert type(registry.get('nested')).__name__ == 'datetime'
+    assert type(registry.get('nested_str')).__name__ == 'datetime'
+    return True
+
+def creator_startup_benchmark(types: int = 500) -> Dict[str, float]:
+    '''
+    Benchmark (executar manualmente): tempo de partida com muitos tipos
+    de produto caros de construir. Compara construir todos os protótipos
+    na criação do Creator (como antes) com o registro preguiçoso, em que
+    só o produto pedido é construído.
+    '''
+    class HeavyProduct(ProductA):
+        def __init__(self) -> None:
+            self.table = [str(i) for i in range(5_000)]
+    
+    classes = [type(f'Product{i}', (HeavyProduct,), {}) for i in range(types)]
+    results = {}
+    start = perf_counter()
+    eager = {f'P{i}': cls() for i, cls in enumerate(classes)}
+    eager['P0'].copy()
+    results['eager'] = perf_counter() - start
+    start = perf_counter()
+    registry = PrototypeRegistry()
+    for i, cls in enumerate(classes):
+        registry.register(f'P{i}', cls)
+    Creator(registry=registry).factoryMethod(product='P0')
+    results['lazy'] = perf_counter() - start
+    for name, seconds in results.items():
+        print(f'{name:>5}: {seconds * 1e3:.2f} ms até o primeiro produto')
+    return results
+
+def pooled_creator_benchmark(n: int = 1_000_000) -> Dict[str, Dict]:
+    '''
+    Benchmark (executar manualmente): n pedidos de produtos de vida cur-
+    ta, com uma cópia por pedido e com o pool. Mede o tempo médio por
+    pedido e quantas coletas do GC aconteceram.
+    '''
+    def clone_per_call() -> None:
+        c = Creator()
+        for i in range(n):
+            product = c.factoryMethod(product='A')
+            product.request = i
+            
+    def pooled() -> None:
+        c = PooledCreator()
+        for i in range(n):
+            product = c.factoryMethod(product='A')
+            product.request = i
+            product.release()
+    
+    results = {}
+    for name, run in (('clone', clone_per_call), ('pool', pooled)):
+        gc.collect()
+        before = sum(stat['collections'] for stat in gc.get_stats())
+        start = perf_counter()
+        run()
+        elapsed = perf_counter() - start
+        after = sum(stat['collections'] for stat in gc.get_stats())
+        results[name] = {'us_per_call': elapsed / n * 1e6,
+                         'gc_collections': after - before}
+        print(f"{name:>5}: {results[name]['us_per_call']:.3f} us/pedido, "
+              f"{results[name]['gc_collections']} coletas do GC")
+    return results
     
 # Main
 def main() -> None:
     assert(factory_method_tests())
+    assert(pooled_creator_tests())
+    assert(registry_tests())
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,14 +5,199 @@ Autor: Sergio P.
 Data: 20/11/2024
 """
 
+import sys
 from abc import ABC, abstractmethod
+from array import array
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
 from typing_extensions import Self
 
+_SHARED = '__shared__'
+
+
+@lru_cache(maxsize=None)
+def _slot_names(cls: type) -> Tuple[str, ...]:
+    '''
+    Nomes (já com name mangling) de todos os __slots__ da hierarquia
+    '''
+    slots: List[str] = []
+    for klass in cls.__mro__:
+        names = vars(klass).get('__slots__', ())
+        for name in (names,) if isinstance(names, str) else names:
+            if name in ('__dict__', '__weakref__'):
+                continue
+            if name.startswith('__') and not name.endswith('__'):
+                name = f'_{klass.__name__.lstrip("_")}{name}'
+            slots.append(name)
+    return tuple(slots)
+
+
+@lru_cache(maxsize=None)
+def _cloner(cls: type) -> Callable[[object], object]:
+    '''
+    Monta, uma vez por classe, a função que faz a cópia rasa de uma ins-
+    tância: cria o objeto sem chamar o __init__ e copia o __dict__ e os
+    __slots__. Não há eval do nome da classe, então funciona também com
+    subclasses definidas fora deste módulo.
+    '''
+    new = cls.__new__
+    slots = _slot_names(cls)
+    has_dict = cls.__dictoffset__ != 0
+    setattr_ = object.__setattr__
+    
+    if not slots:
+        def clone(obj: object) -> object:
+            instance = new(cls)
+            setattr_(instance, '__dict__', obj.__dict__.copy())
+            return instance
+        return clone
+    
+    def clone(obj: object) -> object:
+        instance = new(cls)
+        if has_dict:
+            setattr_(instance, '__dict__', obj.__dict__.copy())
+        for name in slots:
+            try:
+                setattr_(instance, name, getattr(obj, name))
+            except AttributeError:
+                pass
+        return instance
+    return clone
+
+
 class Prototype(ABC):
+    '''
+    Além da cópia comum, o protótipo oferece cópias copy-on-write: o pr-
+    otótipo e as suas cópias passam a compartilhar um único dicionário
+    de atributos, e cada objeto só ganha a sua própria cópia na primei-
+    ra escrita. Para quem usa, a semântica é a mesma da cópia comum; a
+    diferença é que ler atributos compartilhados passa pelo __getattr__
+    e vars() mostra apenas a referência ao estado compartilhado.
+    
+    Enquanto compartilham estado, os objetos são de uma subclasse gerada
+    com o CopyOnWrite; ao ganhar o próprio estado voltam à classe origi-
+    nal. Assim os protótipos comuns não pagam nada nas escritas.
+    
+    Objetos só com __slots__ (sem __dict__) sempre usam a cópia comum.
+    '''
+    
+    __slots__ = ()
     
     @abstractmethod
     def copy(self) -> None:
         pass
+    
+    def copy_many(self, n: int, cow: bool = False) -> List[Self]:
+        '''
+        Cria n cópias de uma vez, buscando a função de cópia só uma vez
+        '''
+        if cow:
+            self._share()
+        clone = _cloner(type(self))
+        return [clone(self) for _ in range(n)]
+    
+    def copy_on_write(self) -> Self:
+        self._share()
+        return _cloner(type(self))(self)
+    
+    def _share(self) -> None:
+        '''
+        Move os atributos para um dicionário compartilhado e troca a cla-
+        sse pela versão copy-on-write. Como a cópia comum copia o
+        __dict__, que agora só tem a referência, as cópias passam a com-
+        partilhar o mesmo estado
+        '''
+        try:
+            state = object.__getattribute__(self, '__dict__')
+        except AttributeError:
+            return
+        if _SHARED not in state:
+            shared = dict(state)
+            state.clear()
+            state[_SHARED] = shared
+            object.__setattr__(self, '__class__', _cow_class(type(self)))
+
+
+class CopyOnWrite:
+    '''
+    Mixin das instâncias que compartilham estado. A primeira escrita co-
+    pia o estado compartilhado para o próprio __dict__ e devolve o obj-
+    eto à classe original, de onde a escrita segue normalmente
+    '''
+    
+    __slots__ = ()
+    
+    _cow_base : type
+    
+    def _materialize(self) -> None:
+        state = object.__getattribute__(self, '__dict__')
+        shared = state.pop(_SHARED, None)
+        if shared is not None:
+            state.update(shared)
+        object.__setattr__(self, '__class__', type(self)._cow_base)
+    
+    def __getattr__(self, name: str):
+        '''
+        Só é chamado quando a busca normal falha: procura no estado com-
+        partilhado
+        '''
+        try:
+            return object.__getattribute__(self, '__dict__')[_SHARED][name]
+        except KeyError:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            ) from None
+        
+    def __setattr__(self, name: str, value: object) -> None:
+        self._materialize()
+        setattr(self, name, value)
+        
+    def __delattr__(self, name: str) -> None:
+        self._materialize()
+        delattr(self, name)
+
+
+@lru_cache(maxsize=None)
+def _cow_class(cls: type) -> type:
+    '''
+    Subclasse copy-on-write de cls, criada uma vez por classe. Não acre-
+    scenta slots, então o __class__ pode ser trocado nos dois sentidos.
+    O mixin vem depois de cls nas bases para manter o layout, e por isso
+    os ganchos são copiados para a própria subclasse
+    '''
+    if issubclass(cls, CopyOnWrite):
+        return cls
+    hooks = ('_materialize', '__getattr__', '__setattr__', '__delattr__')
+    return type(cls)(cls.__name__, (cls, CopyOnWrite), {
+        **{name: vars(CopyOnWrite)[name] for name in hooks},
+        '__slots__': (),
+        '__module__': cls.__module__,
+        '__qualname__': cls.__qualname__,
+        '_cow_base': cls,
+    })
+
+
+def cow_report(products: Iterable[Prototype]) -> Dict[str, int]:
+    '''
+    Quantos objetos ainda compartilham estado, quantos já têm o seu, e a
+    memória economizada em relação a cópias comuns (bytes, estimativa
+    rasa com sys.getsizeof)
+    '''
+    sharing, materialized, saved = 0, 0, 0
+    shared_states: Dict[int, dict] = {}
+    for p in products:
+        state = getattr(p, '__dict__', {})
+        shared = state.get(_SHARED)
+        if shared is None:
+            materialized += 1
+            continue
+        sharing += 1
+        shared_states[id(shared)] = shared
+        saved += sys.getsizeof(shared) - sys.getsizeof(state)
+    saved -= sum(sys.getsizeof(shared) for shared in shared_states.values())
+    return {'sharing': sharing, 'materialized': materialized,
+            'bytes_saved': max(saved, 0)}
 
 
 class Product(Prototype):
@@ -21,13 +206,139 @@ class Product(Prototype):
         self.bar = 2
         
     def copy(self) -> Self:
-        object = eval(type(self).__name__)
-        newInstance = object.__new__(object)
-        newInstance.__dict__ = self.__dict__.copy()
-        return newInstance
+        return _cloner(type(self))(self)
+
+
+class SlottedProduct(Prototype):
+    '''
+    Um produto com __slots__, sem __dict__, mais leve em memória
+    '''
+    
+    __slots__ = ('bar',)
+    
+    def __init__(self) -> None:
+        self.bar = 2
+        
+    def copy(self) -> Self:
+        return _cloner(type(self))(self)
         
 
 
+class ProductBatch:
+    '''
+    Geração em massa de produtos quase idênticos. Ao invés de n objetos,
+    cada um com o seu __dict__, o lote guarda um atributo por coluna
+    (struct-of-arrays): atributos int e float viram um array compacto de
+    números, os demais uma lista.
+    
+    batch[i] devolve uma visão leve da linha i, que lê e escreve direto
+    nas colunas, e to_product(i) converte a linha em um produto de ver-
+    dade. fill e apply atualizam um atributo em todos os produtos de
+    uma vez.
+    '''
+    
+    TYPECODES = {int: 'q', float: 'd'}
+    
+    _columns : Dict[str, Any]
+    
+    def __init__(self, prototype: Prototype, n: int) -> None:
+        self._cls = getattr(type(prototype), '_cow_base', type(prototype))
+        self._n = n
+        self._columns = {}
+        for name, value in self._attributes(prototype).items():
+            self._columns[name] = self._column([value], n)
+            
+    @staticmethod
+    def _attributes(obj: Prototype) -> Dict[str, Any]:
+        attributes = dict(getattr(obj, '__dict__', {}))
+        attributes.update(attributes.pop(_SHARED, {}))
+        for name in _slot_names(type(obj)):
+            if hasattr(obj, name):
+                attributes[name] = getattr(obj, name)
+        return attributes
+    
+    @classmethod
+    def _column(cls, values: List[Any], repeat: int = 1) -> Any:
+        if not values:
+            return []
+        code = cls.TYPECODES.get(type(values[0]))
+        if code is not None and all(type(v) is type(values[0])
+                                    for v in values):
+            try:
+                return array(code, values) * repeat
+            except OverflowError:
+                pass
+        return list(values) * repeat
+    
+    def __len__(self) -> int:
+        return self._n
+    
+    def __getitem__(self, index: int) -> 'ProductView':
+        if index < 0:
+            index += self._n
+        if not 0 <= index < self._n:
+            raise IndexError('Índice fora do lote')
+        return ProductView(self, index)
+    
+    def __iter__(self) -> Iterator['ProductView']:
+        return (ProductView(self, i) for i in range(self._n))
+    
+    def column(self, name: str) -> Any:
+        return self._columns[name]
+    
+    def fill(self, name: str, value: Any) -> None:
+        self._columns[name] = self._column([value], self._n)
+        
+    def apply(self, name: str, function: Callable[[Any], Any]) -> None:
+        '''
+        Em um lote vazio a coluna fica como está, com o mesmo tipo
+        '''
+        column = self._columns[name]
+        if column:
+            self._columns[name] = self._column(list(map(function, column)))
+        
+    def _set(self, name: str, index: int, value: Any) -> None:
+        column = self._columns.get(name)
+        if column is None:
+            raise AttributeError(f'O lote não tem a coluna {name}')
+        try:
+            column[index] = value
+        except (TypeError, OverflowError):
+            column = self._columns[name] = list(column)
+            column[index] = value
+        
+    def to_product(self, index: int) -> Prototype:
+        instance = self._cls.__new__(self._cls)
+        for name, column in self._columns.items():
+            object.__setattr__(instance, name, column[index])
+        return instance
+
+
+class ProductView:
+    '''
+    Visão de uma linha de um ProductBatch. Não guarda atributos próprios,
+    apenas o lote e o índice
+    '''
+    
+    __slots__ = ('_batch', '_index')
+    
+    def __init__(self, batch: ProductBatch, index: int) -> None:
+        object.__setattr__(self, '_batch', batch)
+        object.__setattr__(self, '_index', index)
+        
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._batch.column(name)[self._index]
+        except KeyError:
+            raise AttributeError(name) from None
+        
+    def __setattr__(self, name: str, value: Any) -> None:
+        self._batch._set(name, self._index, value)
+        
+    def to_product(self) -> Prototype:
+        return self._batch.to_product(self._index)
+
+
 # Testes
 def prototype_tests() -> bool:            
     proto_product = Product()
@@ -40,10 +351,108 @@ def prototype_tests() -> bool:
     products[0].bar = 3
     assert(products[0].bar != products[1].bar)
     return True
+
+def copy_many_tests() -> bool:
+    class External(Product):
+        pass
+    
+    proto = External()
+    proto.bar = 7
+    assert(type(proto.copy()) == External)
+    for proto in (Product(), SlottedProduct(), External()):
+        products = proto.copy_many(100)
+        assert(len({id(p) for p in products}) == 100)
+        assert(all(type(p) == type(proto) and p.bar == proto.bar
+                   for p in products))
+        products[0].bar = 3
+        assert(products[1].bar == proto.bar)
+    return True
+
+def copy_on_write_tests() -> bool:
+    proto = Product()
+    proto.table = {i: str(i) for i in range(1000)}
+    for i in range(50):
+        setattr(proto, f'attr{i}', i)
+    products = proto.copy_many(1000, cow=True)
+    assert(all(isinstance(p, Product) and p.bar == 2 for p in products))
+    assert(cow_report(products)['sharing'] == 1000)
+    products[0].bar = 3
+    assert(products[0].bar != products[1].bar)
+    proto.bar = 5
+    assert(products[1].bar == 2 and products[0].attr7 == 7)
+    del products[2].attr0
+    assert(not hasattr(products[2], 'attr0') and products[3].attr0 == 0)
+    assert(type(products[0]) == Product and type(products[1]) != Product)
+    assert(type(Product()).__setattr__ is object.__setattr__)
+    report = cow_report(products)
+    assert(report['sharing'] == 998 and report['materialized'] == 2)
+    assert(report['bytes_saved'] > 0)
+    one = proto.copy_on_write()
+    assert(one.bar == 5 and products[4].bar == 2)
+    slotted = SlottedProduct().copy_many(3, cow=True)
+    slotted[0].bar = 3
+    assert(slotted[1].bar == 2)
+    return True
+
+def product_batch_tests() -> bool:
+    proto = Product()
+    proto.name = 'produto'
+    batch = ProductBatch(proto, 10_000)
+    assert(len(batch) == 10_000 and batch[-1].bar == 2)
+    assert(isinstance(batch.column('bar'), array))
+    batch[5].bar = 9
+    assert(batch.column('bar')[5] == 9 and batch[6].bar == 2)
+    batch.fill('bar', 4)
+    batch.apply('bar', lambda bar: bar * 2)
+    assert(all(p.bar == 8 for p in batch))
+    batch[0].bar = 2.5
+    assert(batch[0].bar == 2.5 and batch[1].bar == 8)
+    product = batch[3].to_product()
+    assert(type(product) == Product)
+    assert(product.bar == 8 and product.name == 'produto')
+    product.bar = 1
+    assert(batch[3].bar == 8)
+    assert(ProductBatch(SlottedProduct(), 3)[2].bar == 2)
+    empty = ProductBatch(proto, 0)
+    empty.apply('bar', lambda bar: bar * 2)
+    empty.fill('name', 'vazio')
+    assert(len(empty) == 0 and isinstance(empty.column('bar'), array))
+    assert(list(empty) == [] and ProductBatch._column([]) == [])
+    assert(sys.getsizeof(batch.column('bar')) < 10_000 * 16)
+    return True
+
+def prototype_benchmark(n: int = 1_000_000) -> Dict[str, float]:
+    '''
+    Benchmark (executar manualmente): cópias por segundo da cópia antiga
+    com eval, de copy em laço e de copy_many
+    '''
+    def eval_copy(obj: Product) -> Product:
+        object = eval(type(obj).__name__)
+        newInstance = object.__new__(object)
+        newInstance.__dict__ = obj.__dict__.copy()
+        return newInstance
+    
+    proto, slotted = Product(), SlottedProduct()
+    cases: Dict[str, Callable[[], List]] = {
+        'eval': lambda: [eval_copy(proto) for _ in range(n)],
+        'copy': lambda: [proto.copy() for _ in range(n)],
+        'copy_many': lambda: proto.copy_many(n),
+        'copy_many (slots)': lambda: slotted.copy_many(n),
+    }
+    results = {}
+    for name, run in cases.items():
+        start = perf_counter()
+        run()
+        results[name] = n / (perf_counter() - start)
+        print(f'{name:>18}: {results[name]:,.0f} cópias/s')
+    return results
                 
 # Main
 def main() -> None:
     assert(prototype_tests())
+    assert(copy_many_tests())
+    assert(copy_on_write_tests())
+    assert(product_batch_tests())
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,22 +5,36 @@ Autor: Sergio P.
 Data: 10/11/2024
 """
 
-from typing import Dict
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from inspect import Parameter, signature
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
+from time import monotonic, perf_counter, sleep
+from typing import Dict, Hashable, Iterable, Type
 from typing_extensions import Self
-from threading import Lock, Thread
+from threading import Barrier, Lock, RLock, Thread
 
 class SingletonLazy:
     '''
     SingletonLazy: construtor não cria uma instancia. Ao invés disso,
     um método de classe é usado como forma global de acesso à instância.    
+    
+    A criação usa um lock com dupla verificação, para que duas threads
+    não criem instâncias diferentes ao mesmo tempo.
     '''
     
     __instance: Self = None
+    __lock: Lock = Lock()
             
     @classmethod
     def get_instance(cls) -> Self:
         if not cls.__instance:
-            cls.__instance = SingletonLazy()
+            with cls.__lock:
+                if not cls.__instance:
+                    cls.__instance = SingletonLazy()
         return cls.__instance
     
 # Teste SingletonLazy
@@ -33,6 +47,95 @@ def singleton_lazy_tests() -> bool:
     return True
 
 
+class SingletonLazyAsync:
+    '''
+    SingletonLazyAsync: versão preguiçosa para singletons com iniciali-
+    zação assíncrona (_initialize), como abrir um pool de conexões. O
+    get_instance é aguardável, e chamadas concorrentes compartilham uma
+    única inicialização em andamento, ao invés de abrir recursos dupli-
+    cados. Se a inicialização falhar, todos os que esperavam recebem o
+    erro e a próxima chamada tenta de novo.
+    
+    Depois de criada, a instância também é acessível de forma síncrona
+    e sem espera, por get_instance_nowait. Cada subclasse tem a sua ins-
+    tância. A inicialização em andamento pertence ao event loop que a
+    começou.
+    '''
+    
+    __instances: Dict[Type, Self] = {}
+    __pending: Dict[Type, asyncio.Future] = {}
+    
+    async def _initialize(self) -> None:
+        pass
+    
+    @classmethod
+    async def __create(cls) -> Self:
+        try:
+            instance = cls()
+            await instance._initialize()
+            cls.__instances[cls] = instance
+            return instance
+        finally:
+            del cls.__pending[cls]
+    
+    @classmethod
+    async def get_instance(cls) -> Self:
+        instance = cls.__instances.get(cls)
+        if instance is not None:
+            return instance
+        pending = cls.__pending.get(cls)
+        if pending is None:
+            pending = asyncio.ensure_future(cls.__create())
+            cls.__pending[cls] = pending
+        return await asyncio.shield(pending)
+    
+    @classmethod
+    def get_instance_nowait(cls) -> Self:
+        try:
+            return cls.__instances[cls]
+        except KeyError:
+            raise RuntimeError(f'{cls.__name__} ainda não foi inicializado') \
+                from None
+        
+        
+class ConnectionPool(SingletonLazyAsync):
+    '''
+    Exemplo: abrir o pool é lento, e não pode acontecer duas vezes
+    '''
+    opened: int = 0
+    fail_next: bool = False
+    
+    async def _initialize(self) -> None:
+        await asyncio.sleep(0.01)
+        if ConnectionPool.fail_next:
+            ConnectionPool.fail_next = False
+            raise ConnectionError('Falha ao abrir o pool')
+        ConnectionPool.opened += 1
+
+# Teste SingletonLazyAsync
+def singleton_lazy_async_tests() -> bool:
+    async def scenario() -> None:
+        ConnectionPool.fail_next = True
+        results = await asyncio.gather(
+            *(ConnectionPool.get_instance() for _ in range(10)),
+            return_exceptions=True
+        )
+        assert(all(isinstance(r, ConnectionError) for r in results))
+        pools = await asyncio.gather(
+            *(ConnectionPool.get_instance() for _ in range(10))
+        )
+        assert(ConnectionPool.opened == 1)
+        assert(all(pool is pools[0] for pool in pools))
+        assert(ConnectionPool.get_instance_nowait() is pools[0])
+    
+    try:
+        ConnectionPool.get_instance_nowait()
+    except RuntimeError:
+        pass
+    asyncio.run(scenario())
+    return True
+
+
 class SingletonMonostate:
     '''
     SingletonMonostate: múltiplas instâncias são permitidas, mas elas
@@ -90,13 +193,24 @@ class SingletonMetaclassMultiThread(type):
     SingletonMetaclassMultiThread: Em situações de várias threads, o si-
     ngleton simples pode falhar. Assim, é necessária precaução e o uso
     do Lock para impedir a falha.
+    
+    O lock só é necessário na primeira construção. Depois que a instân-
+    cia existe, a busca é feita sem lock nenhum (caminho rápido), e ca-
+    da classe tem o seu próprio lock, para que a construção de um sing-
+    leton não bloqueie a de outro.
     '''
     
     __instances : Dict = {}
+    __locks : Dict = {}
     __lock : Lock = Lock()
     
     def __call__(cls, *args, **kwds):
+        instance = cls.__instances.get(cls)
+        if instance is not None:
+            return instance
         with cls.__lock:
+            lock = cls.__locks.setdefault(cls, Lock())
+        with lock:
             '''
             A primeira thread que passar pela call vai adquirir o lock e
             criar a instância. Todas as outras até podem entrar em call
@@ -131,13 +245,433 @@ def singleton_metaclass_multi_thread_test() -> bool:
     process1.start()
     process2.start()
     return True
+
+def singleton_metaclass_contention_test() -> bool:
+    class Heavy(metaclass=SingletonMetaclassMultiThread):
+        created = 0
+        def __init__(self) -> None:
+            Heavy.created += 1
+    
+    instances = []
+    barrier = Barrier(16)
+    
+    def worker() -> None:
+        barrier.wait()
+        instances.append(Heavy())
+        
+    workers = [Thread(target=worker) for _ in range(16)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert(Heavy.created == 1)
+    assert(all(ins is instances[0] for ins in instances))
+    return True
+
+def singleton_lookup_benchmark(threads: Iterable[int] = (1, 2, 4, 8, 16),
+                               calls: int = 200_000) -> Dict[int, float]:
+    '''
+    Benchmark (executar manualmente): mede quantas buscas por segundo o
+    LoggerMultiThread atende com a instância já criada, conforme o núm-
+    ero de threads cresce. Cada thread faz calls buscas.
+    '''
+    LoggerMultiThread(key='bench')
+    results = {}
+    for n in threads:
+        barrier = Barrier(n + 1)
+        
+        def worker() -> None:
+            barrier.wait()
+            for _ in range(calls):
+                LoggerMultiThread(key='bench')
+        
+        workers = [Thread(target=worker) for _ in range(n)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        start = perf_counter()
+        for w in workers:
+            w.join()
+        results[n] = n * calls / (perf_counter() - start)
+        print(f'{n:>3} threads: {results[n]:,.0f} buscas/s')
+    return results
+    
+
+
+
+class MultitonMetaclass(type):
+    '''
+    MultitonMetaclass: uma instância por combinação de argumentos do
+    construtor, ao invés de uma por classe. Os argumentos são normali-
+    zados pela assinatura do __init__ (posicionais, nomeados e valores
+    padrão dão a mesma chave), então Tenant('a') e Tenant(key='a') são
+    o mesmo objeto.
+    
+    O registro de cada classe é limitado: guarda no máximo multiton_max-
+    size instâncias, descartando a menos usada recentemente (LRU), e
+    instâncias mais velhas que multiton_ttl segundos expiram. Uma ins-
+    tância descartada tem o seu close chamado, se existir.
+    
+    A construção acontece fora do lock do registro, então um construtor
+    lento não atrasa os pedidos das outras chaves. Pedidos simultâneos
+    da mesma chave esperam a construção em andamento (um Future por
+    chave) ao invés de construir de novo.
+    '''
+    
+    __registries : Dict = {}
+    __lock : Lock = Lock()
+    
+    def __registry(cls) -> Dict:
+        registry = cls.__registries.get(cls)
+        if registry is None:
+            with cls.__lock:
+                registry = cls.__registries.setdefault(cls, {
+                    'instances': OrderedDict(),
+                    'building': {},
+                    'lock': Lock(),
+                    'signature': signature(cls.__init__),
+                    'hits': 0, 'misses': 0, 'evictions': 0,
+                })
+        return registry
+    
+    @staticmethod
+    def __key(registry: Dict, args: tuple, kwds: dict) -> Hashable:
+        bound = registry['signature'].bind(None, *args, **kwds)
+        bound.apply_defaults()
+        key = []
+        for name, value in list(bound.arguments.items())[1:]:
+            kind = registry['signature'].parameters[name].kind
+            if kind is Parameter.VAR_KEYWORD:
+                value = tuple(sorted(value.items()))
+            value = MultitonMetaclass.__frozen(value)
+            try:
+                hash(value)
+            except TypeError:
+                raise TypeError(
+                    f"O argumento '{name}' não pode compor a chave do "
+                    f"multiton: {type(value).__name__} não é hashable"
+                ) from None
+            key.append((name, value))
+        return tuple(key)
+    
+    @staticmethod
+    def __frozen(value):
+        '''
+        Versão hashable de listas, dicionários e conjuntos (inclusive ani-
+        nhados), para que T(['a']) e T(['a']) tenham a mesma chave
+        '''
+        if isinstance(value, (list, tuple)):
+            return tuple(MultitonMetaclass.__frozen(v) for v in value)
+        if isinstance(value, dict):
+            return tuple((k, MultitonMetaclass.__frozen(v))
+                         for k, v in value.items())
+        if isinstance(value, set):
+            return frozenset(value)
+        return value
+    
+    def __call__(cls, *args, **kwds):
+        registry = cls.__registry()
+        key = cls.__key(registry, args, kwds)
+        instances = registry['instances']
+        building = registry['building']
+        ttl = getattr(cls, 'multiton_ttl', None)
+        evicted = []
+        with registry['lock']:
+            entry = instances.get(key)
+            if entry is not None and ttl is not None \
+                    and monotonic() - entry[0] > ttl:
+                evicted.append(instances.pop(key)[1])
+                registry['evictions'] += 1
+                entry = None
+            if entry is not None:
+                instances.move_to_end(key)
+                registry['hits'] += 1
+            else:
+                future = building.get(key)
+                owner = future is None
+                if owner:
+                    registry['misses'] += 1
+                    future = building[key] = Future()
+                else:
+                    registry['hits'] += 1
+        cls.__close(evicted)
+        if entry is not None:
+            return entry[1]
+        if not owner:
+            return future.result()
+        try:
+            instance = super(MultitonMetaclass, cls).__call__(*args, **kwds)
+        except BaseException as error:
+            with registry['lock']:
+                del building[key]
+            future.set_exception(error)
+            raise
+        evicted = []
+        with registry['lock']:
+            del building[key]
+            instances[key] = (monotonic(), instance)
+            while len(instances) > getattr(cls, 'multiton_maxsize', 128):
+                evicted.append(instances.popitem(last=False)[1][1])
+            registry['evictions'] += len(evicted)
+        future.set_result(instance)
+        cls.__close(evicted)
+        return instance
+    
+    @staticmethod
+    def __close(instances: Iterable) -> None:
+        for old in instances:
+            close = getattr(old, 'close', None)
+            if close is not None:
+                close()
+    
+    def multiton_stats(cls) -> Dict[str, int]:
+        registry = cls.__registry()
+        return {
+            'hits': registry['hits'],
+            'misses': registry['misses'],
+            'evictions': registry['evictions'],
+            'size': len(registry['instances']),
+        }
+    
+
+class TenantLogger(metaclass=MultitonMetaclass):
+    '''
+    Um logger por cliente (tenant), com no máximo dois abertos ao mesmo
+    tempo
+    '''
+    multiton_maxsize: int = 2
+    multiton_ttl: float = None
+    
+    def __init__(self, key: str, level: str = 'INFO') -> None:
+        self.key = key
+        self.level = level
+        self.closed = False
+        
+    def close(self) -> None:
+        self.closed = True
+
+class SlowTenant(metaclass=MultitonMetaclass):
+    '''
+    Um multiton de teste com construtor lento
+    '''
+    built = []
+    
+    def __init__(self, key: str, delay: float = 0.0) -> None:
+        if delay:
+            sleep(delay)
+        self.key = key
+        SlowTenant.built.append(key)
+
+# Teste MultitonMetaclass
+def multiton_tests() -> bool:
+    foo = TenantLogger('foo')
+    assert(TenantLogger(key='foo', level='INFO') is foo)
+    bar = TenantLogger(key='bar')
+    assert(bar is not foo and bar.key == 'bar')
+    assert(TenantLogger('foo') is foo)
+    assert(TenantLogger('foo', 'DEBUG') is not foo)
+    assert(bar.closed and not foo.closed)
+    assert(TenantLogger.multiton_stats() == {
+        'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2
+    })
+    TenantLogger.multiton_ttl = 0.0
+    assert(TenantLogger('foo') is not foo and foo.closed)
+    TenantLogger.multiton_ttl = None
+    slow = Thread(target=SlowTenant, args=('lento', 0.5))
+    slow.start()
+    sleep(0.05)
+    start = monotonic()
+    assert(SlowTenant('rapido').key == 'rapido')
+    assert(monotonic() - start < 0.25)
+    waiters = [Thread(target=SlowTenant, args=('lento', 0.5))
+               for _ in range(4)]
+    for thread in waiters:
+        thread.start()
+    for thread in [slow, *waiters]:
+        thread.join()
+    assert(SlowTenant.built == ['rapido', 'lento'])
+    assert(SlowTenant.multiton_stats()['misses'] == 2)
+    tags = TenantLogger(['a', {'b': [1]}])
+    assert(TenantLogger(['a', {'b': [1]}]) is tags)
+    try:
+        TenantLogger(key=[bytearray()])
+    except TypeError as error:
+        assert("'key'" in str(error))
+    else:
+        return False
+    return True
+
+
+class SingletonMetaclassForkSafe(type):
+    '''
+    SingletonMetaclassForkSafe: singletons comuns são por processo. Num
+    pool de processos, cada trabalhador cria o seu e repete a inicial-
+    ização cara. Aqui, a instância é criada uma vez no processo pai, an-
+    tes do fork (preload), e os filhos herdam o objeto já pronto, com a
+    memória compartilhada por copy-on-write.
+    
+    Ganchos de fork (os.register_at_fork) deixam isso seguro: o lock do
+    registro nunca é herdado no meio de uma construção, e cada instân-
+    cia pode definir _after_fork para refazer, no filho, o que não so-
+    brevive ao fork (conexões, threads, arquivos). O lock é reentrante,
+    então um construtor pode criar processos (um pool de trabalhadores,
+    por exemplo) sem travar no próprio gancho.
+    '''
+    
+    __instances : Dict = {}
+    __lock : RLock = RLock()
+    
+    def __call__(cls, *args, **kwds):
+        instance = cls.__instances.get(cls)
+        if instance is not None:
+            return instance
+        with cls.__lock:
+            if cls not in cls.__instances:
+                cls.__instances[cls] = (
+                    super(SingletonMetaclassForkSafe, cls)
+                    .__call__(*args, **kwds)
+                )
+        return cls.__instances[cls]
+    
+    def preload(cls, *args, **kwds) -> Self:
+        '''
+        Cria a instância no processo pai, antes de criar os trabalhadores
+        '''
+        return cls(*args, **kwds)
+    
+    @classmethod
+    def _before_fork(mcs) -> None:
+        mcs.__lock.acquire()
+        
+    @classmethod
+    def _after_fork_parent(mcs) -> None:
+        mcs.__lock.release()
+        
+    @classmethod
+    def _after_fork_child(mcs) -> None:
+        mcs.__lock = RLock()
+        for instance in mcs.__instances.values():
+            hook = getattr(instance, '_after_fork', None)
+            if hook is not None:
+                hook()
+        
+        
+os.register_at_fork(
+    before=SingletonMetaclassForkSafe._before_fork,
+    after_in_parent=SingletonMetaclassForkSafe._after_fork_parent,
+    after_in_child=SingletonMetaclassForkSafe._after_fork_child,
+)
+
+
+class SingletonManager(BaseManager):
+    '''
+    SingletonManager: quando o estado do singleton precisa ser realmente
+    compartilhado (escritas de um processo vistas pelos outros), a ins-
+    tância vive em um processo gerente e os trabalhadores recebem proxi-
+    es para ela. Cada classe registrada é construída uma única vez, no
+    gerente, na primeira vez que alguém pede.
+    
+    Requer o método de início "fork", pois as fábricas registradas não
+    são enviadas por pickle ao gerente.
+    '''
+    
+    _shared : Dict = {}
+    _shared_lock : Lock = Lock()
+    
+    @classmethod
+    def register_singleton(cls, klass: type, *args, **kwds) -> None:
+        def get_instance():
+            with cls._shared_lock:
+                if klass not in cls._shared:
+                    cls._shared[klass] = klass(*args, **kwds)
+                return cls._shared[klass]
+        cls.register(klass.__name__, callable=get_instance)
+        
+        
+class Config(metaclass=SingletonMetaclassForkSafe):
+    '''
+    Um singleton pesado, que não deve ser inicializado em cada processo
+    '''
+    inits: int = 0
+    
+    def __init__(self) -> None:
+        Config.inits += 1
+        self.table = list(range(100_000))
+        self.pid = os.getpid()
+        
+    def _after_fork(self) -> None:
+        self.pid = os.getpid()
+        
+        
+class Counter:
+    '''
+    Estado compartilhado entre processos através do SingletonManager
+    '''
+    inits: int = 0
+    
+    def __init__(self) -> None:
+        Counter.inits += 1
+        self._value = 0
+        
+    def increment(self) -> None:
+        self._value += 1
+        
+    def value(self) -> int:
+        return self._value
+    
+    def created(self) -> int:
+        return Counter.inits
+
+class ForkingService(metaclass=SingletonMetaclassForkSafe):
+    '''
+    Um singleton cujo construtor cria um processo filho
+    '''
+    
+    def __init__(self) -> None:
+        self.child = os.fork()
+        if not self.child:
+            os._exit(0)
+
+# Teste SingletonMetaclassForkSafe e SingletonManager
+def fork_worker(results, manager: SingletonManager) -> None:
+    config = Config()
+    manager.Counter().increment()
+    results.put((Config.inits, config.pid == os.getpid(), len(config.table)))
+
+def singleton_fork_tests() -> bool:
+    ctx = get_context('fork')
+    Config.preload()
+    SingletonManager.register_singleton(Counter)
+    manager = SingletonManager(ctx=ctx)
+    manager.start()
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=fork_worker, args=(results, manager))
+        for _ in range(4)
+    ]
+    for w in workers:
+        w.start()
+    answers = [results.get(timeout=10) for _ in workers]
+    for w in workers:
+        w.join()
+    assert(all(answer == (1, True, 100_000) for answer in answers))
+    assert(manager.Counter().value() == 4)
+    assert(manager.Counter().created() == 1)
+    manager.shutdown()
+    pid = ForkingService().child
+    assert(os.waitpid(pid, 0)[1] == 0)
+    return True
     
 # Main
 def main() -> None:
     assert(singleton_lazy_tests())
+    assert(singleton_lazy_async_tests())
     assert(singleton_monostate_tests())
     assert(singleton_metaclass_tests())
     assert(singleton_metaclass_multi_thread_test())
+    assert(singleton_metaclass_contention_test())
+    assert(multiton_tests())
+    assert(singleton_fork_tests())
     
 if __name__ == "__main__":
     main()
\ No newline at end of file